@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, send_file
 from flask_cors import CORS
 
 import os
@@ -7,9 +7,14 @@ import argparse
 import traceback
 from datetime import datetime
 import uuid
+import itertools
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from urllib.parse import quote
 
 
-from gen_sketch import SketchApp
+from gen_sketch import SketchApp, rasterize_fitted_sketch
 import utils  # Make sure to import utils module
 
 app = Flask(__name__)
@@ -18,6 +23,58 @@ CORS(app, resources={r"/*": {"origins": "*"}})  # More explicit CORS setup
 # Store current sketches in memory
 sketches = {}
 
+# Widths served by /sketch-image, re-rendered from the stored strokes on first request
+IMAGE_SIZES = {"thumbnail": 128, "preview": 306, "full": 612, "2x": 1224}
+# keyed by the sketch's SVG and the width, so an edited sketch never gets a stale image
+image_cache = utils.RenderCache(max_memory_bytes=32 * 1024 * 1024)
+
+# "vector" answers with strokes + SVG and leaves every raster file to the first /download (or /sketch-image) request;
+# "raster" writes the PNGs before responding. Requests may override it with "response_mode".
+RESPONSE_MODES = ("vector", "raster")
+DEFAULT_RESPONSE_MODE = os.environ.get("SKETCHAGENT_RESPONSE_MODE", "vector")
+# download id -> sketch info (stays valid when the concept is regenerated). Infos hold only the fitted strokes and
+# paths, and the oldest are forgotten past SKETCHAGENT_MAX_SKETCHES (their files stay on disk).
+sketch_ids = OrderedDict()
+MAX_SKETCHES = int(os.environ.get("SKETCHAGENT_MAX_SKETCHES", 256))
+registry_lock = threading.Lock()
+# Every stored sketch (generated, regenerated or edited) gets a new version; /edit-sketch in delta mode only sends
+# the strokes added on top of the version the client holds
+sketch_versions = itertools.count(1)
+
+def register_sketch(concept, sketch_id, sketch_info):
+    sketch_info['concept'] = concept
+    sketch_info['lock'] = threading.Lock()  # per sketch, so rasterizing one never waits on another
+    with registry_lock:
+        sketches[concept] = sketch_info
+        sketch_ids[sketch_id] = sketch_info
+        while len(sketch_ids) > MAX_SKETCHES:
+            _, evicted = sketch_ids.popitem(last=False)
+            if sketches.get(evicted['concept']) is evicted:
+                del sketches[evicted['concept']]
+
+def ensure_raster(sketch_info):
+    """Write the sketch's PNGs (results tree and static/sketches) if a vector-mode response skipped them."""
+    with sketch_info['lock']:
+        paths = [sketch_info['public_path'], sketch_info['original_path'], sketch_info.get('canvas_path')]
+        if all(path is None or os.path.exists(path) for path in paths):
+            return
+        args = sketch_info['args']
+        canvas = None
+        if sketch_info.get('canvas_path'):
+            canvas = utils.get_grid_artifacts(res=args.res, cell_size=args.cell_size, header_size=args.cell_size).canvas()
+        image, on_canvas = rasterize_fitted_sketch(sketch_info['sketch'], canvas=canvas, raster_backend=args.raster_backend)
+        os.makedirs(os.path.dirname(sketch_info['public_path']), exist_ok=True)
+        for path, picture in ((sketch_info['public_path'], image), (sketch_info['original_path'], image), (sketch_info.get('canvas_path'), on_canvas)):
+            if path is not None and not os.path.exists(path):
+                utils.save_png(picture, path, args.png_encoding)
+
+def download_path(sketch_id):
+    return f"download/{sketch_id}.png"
+
+def image_urls(sketch_id, version):
+    # one URL per stored version, so a regenerated or edited concept never hits a browser-cached image of the old one
+    return {size: f"/sketch-image?id={quote(sketch_id)}&version={version}&size={size}" for size in IMAGE_SIZES}
+
 def create_args_for_concept(concept):
     """Create args object similar to what argparse would create"""
     args = argparse.Namespace()
@@ -41,6 +98,18 @@ def create_args_for_concept(concept):
     args.stroke_width = 7.0
     args.grid_size = (args.res + 1) * args.cell_size
 
+    # Curve fitting params
+    args.fit_mode = 'adaptive'
+    args.fit_tolerance = 6.0
+    args.stroke_preprocess = 'corners'
+
+    # SVG output params
+    args.svg_profile = 'compact'
+    args.svg_precision = None
+    args.raster_backend = 'cairosvg'
+    args.png_encoding = 'palette'
+    args.tail_attempts = 1
+
     args.save_name = args.concept_to_draw.replace(" ", "_")
     args.path2save = os.path.join(args.path2save, args.save_name)
 
@@ -55,9 +124,15 @@ def generate_sketch():
     try:
         data = request.get_json()
         concept = data.get('concept', '')
+        response_mode = data.get('response_mode', DEFAULT_RESPONSE_MODE)
+        stroke_format = data.get('stroke_format', 'xml')
 
         if not concept:
             return jsonify({"error": "No concept provided"}), 400
+        if response_mode not in RESPONSE_MODES:
+            return jsonify({"error": f"Unknown response_mode '{response_mode}', expected one of {list(RESPONSE_MODES)}"}), 400
+        if stroke_format not in utils.STROKE_DATA_FORMATS:
+            return jsonify({"error": f"Unknown stroke_format '{stroke_format}', expected one of {list(utils.STROKE_DATA_FORMATS)}"}), 400
 
         # Create args for SketchApp
         args = create_args_for_concept(concept)
@@ -66,31 +141,41 @@ def generate_sketch():
         sketch_app = SketchApp(args)
 
         # Generate the sketch and get stroke data
-        stroke_data = sketch_app.generate_sketch()
+        stroke_data = sketch_app.generate_sketch(render=response_mode == "raster", stroke_format=stroke_format)
 
         # Get image path
         image_path = f"{args.path2save}/{args.save_name}.png"
-        public_path = f"static/sketches/{args.save_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-
-        # Copy to static folder for serving
-        os.makedirs(os.path.dirname(f"static/sketches/"), exist_ok=True)
-
-        # Use PIL to copy the image
-        from PIL import Image
-        img = Image.open(image_path)
-        img.save(public_path)
+        sketch_id = f"{args.save_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        public_path = f"static/sketches/{sketch_id}.png"
 
         # Store information for later modifications
-        sketches[concept] = {
+        version = next(sketch_versions)
+        register_sketch(concept, sketch_id, {
             'original_path': image_path,
+            'canvas_path': f"{args.path2save}/{args.save_name}_canvas.png",
             'public_path': public_path,
-            'args': args
-        }
+            'args': args,
+            'sketch': sketch_app.fitted_sketch,
+            'version': version
+        })
+
+        if response_mode == "raster":
+            # Copy to static folder for serving
+            os.makedirs(os.path.dirname(f"static/sketches/"), exist_ok=True)
+
+            # Save the in-memory render instead of reading the PNG back from disk
+            utils.save_png(sketch_app.sketch_rendered, public_path, args.png_encoding)
 
         return jsonify({
             "message": f"Successfully generated sketch of {concept}",
-            "image_path": public_path,
-            "stroke_data": stroke_data
+            "image_path": public_path if response_mode == "raster" else download_path(sketch_id),
+            "image_urls": image_urls(sketch_id, version),
+            "svg": sketch_app.fitted_sketch.svg(),
+            "stroke_data": stroke_data,
+            "stroke_format": stroke_format,
+            "version": version,
+            # strokes of a malformed or cut-off model answer that could not be recovered
+            "dropped_strokes": [{"stroke": tag, "reason": reason} for tag, reason in sketch_app.salvage.dropped]
         })
 
     except Exception as e:
@@ -105,12 +190,20 @@ def edit_sketch():
         data = request.get_json()
         concept = data.get('concept', '')
         objects_to_add = data.get('objects_to_add', [])
+        response_mode = data.get('response_mode', DEFAULT_RESPONSE_MODE)
+        stroke_format = data.get('stroke_format', 'xml')
+        stroke_delta = bool(data.get('stroke_delta', False))
+        base_version = data.get('base_version')
 
         print(f"Request data: concept='{concept}', objects_to_add={objects_to_add}")
 
         if not concept or not objects_to_add:
             print("Missing required parameters")
             return jsonify({"error": "Both concept and objects_to_add must be provided"}), 400
+        if response_mode not in RESPONSE_MODES:
+            return jsonify({"error": f"Unknown response_mode '{response_mode}', expected one of {list(RESPONSE_MODES)}"}), 400
+        if stroke_format not in utils.STROKE_DATA_FORMATS:
+            return jsonify({"error": f"Unknown stroke_format '{stroke_format}', expected one of {list(utils.STROKE_DATA_FORMATS)}"}), 400
 
         # Check if we have this sketch
         if concept not in sketches:
@@ -122,6 +215,13 @@ def edit_sketch():
         original_sketch_info = sketches[concept]
         print(f"Found sketch info: {original_sketch_info}")
 
+        # Delta responses only make sense on top of the version the client holds (when it tells us which one)
+        parent_strokes = original_sketch_info['sketch'].strokes
+        delta = stroke_delta and base_version in (None, original_sketch_info['version'])
+
+        # Editing starts from the rendered image, so produce it now if the sketch was answered in vector mode
+        ensure_raster(original_sketch_info)
+
         # Get the original image path - this is what we need to modify with
         original_image_path = original_sketch_info['original_path']
         print(f"Original image path: {original_image_path}")
@@ -141,7 +241,7 @@ def edit_sketch():
 
         # Save a copy for the modification process
         mod_image_path = os.path.join(modification_dir, f"{concept}_canvas.png")
-        original_image.save(mod_image_path)
+        utils.save_png(original_image, mod_image_path, original_sketch_info['args'].png_encoding)
 
         # Create output directory and copy experiment_log.json
         exp_log_path = os.path.join(base_dir, "experiment_log.json")
@@ -169,7 +269,7 @@ def edit_sketch():
         os.makedirs(output_path, exist_ok=True)
 
         # Copy the original image to where load_sketch_data expects it
-        original_image.save(os.path.join(output_path, output_filename))
+        utils.save_png(original_image, os.path.join(output_path, output_filename), original_sketch_info['args'].png_encoding)
 
         print(f"Set up temporary file at: {os.path.join(output_path, output_filename)}")
 
@@ -180,7 +280,10 @@ def edit_sketch():
             add_objects=objects_to_add,
             reflection_prompt=reflection_prompt,
             cache=False,
-            seed_mode="deterministic"
+            seed_mode="deterministic",
+            stroke_format=stroke_format,
+            first_stroke=len(parent_strokes) if delta else 0,
+            base_sketch=original_sketch_info['sketch']
         )
 
         print(f"Edit sketch results keys: {results.keys() if results else 'None'}")
@@ -188,6 +291,10 @@ def edit_sketch():
         # Get the final image and stroke data from the results
         final_image = results.get("final_image")
         stroke_data = results.get("stroke_data")
+        if delta and not results["sketch"].strokes.starts_with(parent_strokes):
+            # the edit did not build on the strokes the client has, so send the whole sketch
+            delta = False
+            stroke_data = sketch_app.format_edit_stroke_data(results["sketch"].strokes, concept, objects_to_add, stroke_format)
 
         if final_image is None:
             print("No final_image in results")
@@ -199,29 +306,42 @@ def edit_sketch():
         edited_name = edited_concept.replace(" ", "_")
 
         # Create a path in the static folder
-        os.makedirs("static/sketches", exist_ok=True)
-        public_path = f"static/sketches/{edited_name}_{timestamp}.png"
+        sketch_id = f"{edited_name}_{timestamp}"
+        public_path = f"static/sketches/{sketch_id}.png"
         full_public_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), public_path)
 
-        print(f"Will save edited image to {full_public_path}")
-
-        # Save the image
-        final_image.save(full_public_path)
-        print(f"Image saved")
-
         # Store the edited sketch info
-        sketches[edited_concept] = {
+        # the final image is not kept: it is the sketch on white, re-rendered (via the render cache) when needed
+        version = next(sketch_versions)
+        edited_info = {
             'original_path': full_public_path,
             'public_path': public_path,
             'args': original_sketch_info['args'],
-            'parent_concept': concept
+            'parent_concept': concept,
+            'sketch': results.get("sketch"),
+            'version': version
         }
+        register_sketch(edited_concept, sketch_id, edited_info)
+
+        if response_mode == "raster":
+            print(f"Will save edited image to {full_public_path}")
+            ensure_raster(edited_info)
+            print(f"Image saved")
 
         print("=== Successfully completed edit-sketch endpoint ===")
         return jsonify({
             "message": f"Successfully added {', '.join(objects_to_add)} to sketch of {concept}",
-            "image_path": public_path,
-            "stroke_data": stroke_data
+            "image_path": public_path if response_mode == "raster" else download_path(sketch_id),
+            "image_urls": image_urls(sketch_id, version),
+            "svg": results["sketch"].svg(),
+            "stroke_data": stroke_data,
+            "stroke_format": stroke_format,
+            "version": version,
+            "base_version": original_sketch_info['version'],
+            # delta: stroke_data holds only the strokes added by this edit, to be appended after the first first_stroke
+            "delta": delta,
+            "first_stroke": len(parent_strokes) if delta else 0,
+            "dropped_strokes": [{"object": add_object, "stroke": tag, "reason": reason} for add_object, tag, reason in results["dropped_strokes"]]
         })
 
     except Exception as e:
@@ -230,6 +350,42 @@ def edit_sketch():
         print(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+@app.route('/download/<sketch_id>.png', methods=['GET'])
+def download_sketch(sketch_id):
+    sketch_info = sketch_ids.get(sketch_id)
+    if sketch_info is None:
+        return jsonify({"error": f"No sketch found for '{sketch_id}'"}), 404
+    ensure_raster(sketch_info)
+    return send_file(os.path.abspath(sketch_info['public_path']), mimetype='image/png')
+
+@app.route('/sketch-image', methods=['GET'])
+def sketch_image():
+    sketch_id = request.args.get('id', '')
+    version = request.args.get('version', '')
+    size = request.args.get('size', 'full')
+    if size not in IMAGE_SIZES:
+        return jsonify({"error": f"Unknown size '{size}', expected one of {list(IMAGE_SIZES)}"}), 400
+    sketch_info = sketch_ids.get(sketch_id)
+    if sketch_info is None or str(sketch_info['version']) != version:
+        return jsonify({"error": f"No sketch found for '{sketch_id}' version {version}"}), 404
+    sketch = sketch_info['sketch']
+
+    # Vector re-render at the requested width is sharper than resampling the 612px raster
+    png = image_cache.get_or_render(
+        sketch.svg(),
+        lambda: utils.encode_png(sketch.render(width=IMAGE_SIZES[size], pool=utils.get_worker_pool()), sketch_info['args'].png_encoding),
+        size=IMAGE_SIZES[size])
+    # the URL names one immutable version of the sketch, so it can be cached
+    return send_file(BytesIO(png), mimetype='image/png', max_age=3600)
+
+@app.route('/worker-pool-stats', methods=['GET'])
+def worker_pool_stats():
+    return jsonify(utils.get_worker_pool().stats())
+
+@app.route('/render-cache-stats', methods=['GET'])
+def render_cache_stats():
+    return jsonify(utils.get_render_cache().stats())
+
 if __name__ == '__main__':
     # Create static directory if it doesn't exist
     os.makedirs('static/sketches', exist_ok=True)
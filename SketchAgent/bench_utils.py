@@ -0,0 +1,199 @@
+"""
+Microbenchmarks for the stroke processing helpers in utils.py.
+Run from the SketchAgent folder:
+    python bench_utils.py
+"""
+import ast
+import glob
+import json
+import os
+import base64
+import timeit
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+
+import numpy as np
+
+import utils
+from prompts import gt_example
+
+
+def legacy_create_svg_path_data(control_points):
+    # SVG path serialization before the printf-template serializer (np.array2string + str() per coordinate)
+    path_data = 'M ' + np.array2string(np.array(control_points[0]), formatter={'float_kind': lambda x: "%.2f" % x}, separator=' ')[1:-1]
+    path_data += {1: ' ', 2: ' L ', 3: ' Q ', 4: ' C '}[len(control_points)]
+    for point in control_points[1:]:
+        path_data += str(point[0]) + " " + str(point[1]) + " "
+    return path_data
+
+
+def legacy_format_svg(all_control_points, dim, stroke_width):
+    svg_width, svg_height = dim
+    sketch_text_svg = f"""<svg width="{svg_width}" height="{svg_height}" xmlns="http://www.w3.org/2000/svg">\n"""
+    for i, path in enumerate(all_control_points):
+        gropu_text = f"""<g id="s{i + 1}" stroke="black" stroke-width="{stroke_width}" fill="none" stroke-linecap="round">\n"""
+        for sub_path_cp in path:
+            gropu_text += f"""<path d="{legacy_create_svg_path_data(sub_path_cp)}"/>\n"""
+        gropu_text += "</g>\n"
+        sketch_text_svg += gropu_text
+    sketch_text_svg += "</svg>"
+    return sketch_text_svg
+
+
+def sample_sketch(num_strokes=30, seed=0):
+    """A random sketch of num_strokes strokes with 2-9 cells each, plus the strokes of the prompt example."""
+    rng = np.random.default_rng(seed)
+    strokes_xy, strokes_t = [], []
+    for _ in range(num_strokes):
+        n = int(rng.integers(2, 10))
+        strokes_xy.append(rng.integers(1, 51, size=(n, 2)))
+        strokes_t.append(np.linspace(0, 1, n))
+    strokes = utils.StrokeBuffer.from_arrays(strokes_xy, strokes_t)
+    return strokes.extend(utils.parse_strokes(gt_example, res=50))
+
+
+# Recorded runs: the repo-root results/ and the SketchAgent/results/ tree the API writes to, wherever this is run from
+SKETCHAGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIRS = (os.path.join(os.path.dirname(SKETCHAGENT_DIR), "results"), os.path.join(SKETCHAGENT_DIR, "results"))
+
+
+def recorded_outputs(results_dirs=RESULTS_DIRS):
+    """Assistant replies holding a <strokes> block from the experiment logs under results_dirs."""
+    outputs = []
+    log_paths = [path for results_dir in results_dirs
+                 for path in glob.glob(os.path.join(results_dir, "**", "experiment_log.json"), recursive=True)]
+    for log_path in log_paths:
+        with open(log_path) as log_file:
+            messages = json.load(log_file)
+        for message in messages:
+            if message.get("role") != "assistant":
+                continue
+            content = message["content"]
+            texts = [content] if isinstance(content, str) else [part.get("text", "") for part in content]
+            outputs.extend(text for text in texts if "<strokes>" in text and "</strokes>" in text)
+    if not outputs:
+        raise FileNotFoundError(f"No recorded <strokes> outputs in the {len(log_paths)} experiment_log.json file(s) under {list(results_dirs)}")
+    return outputs
+
+
+def legacy_parse_strokes(llm_output, res):
+    # Parsing before parse_stroke_block: ElementTree + string rebuild + two clamping re.sub passes + literal_eval
+    strokes_list_str, t_values_str = utils.parse_xml_string(llm_output, res)
+    strokes_list, t_values = ast.literal_eval(strokes_list_str), ast.literal_eval(t_values_str)
+    return utils.StrokeBuffer.from_lists(strokes_list, t_values, res=res)
+
+
+def report(name, legacy, new, number):
+    t_legacy = timeit.timeit(legacy, number=number) / number
+    t_new = timeit.timeit(new, number=number) / number
+    print(f"{name:<28} legacy {t_legacy * 1e6:9.1f} us   new {t_new * 1e6:9.1f} us   speedup x{t_legacy / t_new:.1f}")
+
+
+def bench_svg(number=500):
+    strokes = sample_sketch()
+    control_points = utils.get_control_points(strokes, None, utils.CellGrid(50, 12), fit_mode="adaptive")
+    dim = (612, 612)
+    report("format_svg (1 sketch)", lambda: legacy_format_svg(control_points, dim, 7.0),
+           lambda: utils.format_svg(control_points, dim, 7.0), number)
+    batch = [control_points] * 32
+    report("format_svg_batch (32)", lambda: [legacy_format_svg(cp, dim, 7.0) for cp in batch],
+           lambda: utils.format_svg_batch(batch, dim, 7.0), max(1, number // 32))
+    report("format_svg compact", lambda: legacy_format_svg(control_points, dim, 7.0),
+           lambda: utils.format_svg(control_points, dim, 7.0, profile="compact"), number)
+
+    sizes = {"legacy": len(legacy_format_svg(control_points, dim, 7.0))}
+    for profile in utils.SVG_PROFILES:
+        for precision in (0, 1, 2):
+            sizes[f"{profile} p={precision}"] = len(utils.format_svg(control_points, dim, 7.0, precision=precision, profile=profile))
+    for name, size in sizes.items():
+        print(f"{'svg size ' + name:<28} {size:7d} bytes  ({size / sizes['legacy']:.0%} of legacy)")
+
+
+def bench_fit(number=100):
+    strokes = sample_sketch()
+    grid = utils.CellGrid(50, 12)
+    for fit_mode in ("adaptive", "catmull_rom"):
+        for preprocess in (False, "corners", "runs"):
+            t_fit = timeit.timeit(lambda: utils.get_control_points(strokes, None, grid, fit_mode=fit_mode, preprocess=preprocess), number=number) / number
+            print(f"{'fit ' + fit_mode + ' ' + (preprocess or 'none'):<28} new {t_fit * 1e6:9.1f} us")
+
+
+def bench_parse(number=200):
+    outputs = recorded_outputs()
+    print(f"parsing {len(outputs)} recorded output(s)")
+    report("parse_strokes", lambda: [legacy_parse_strokes(text, 50) for text in outputs],
+           lambda: [utils.parse_strokes(text, 50) for text in outputs], max(1, number // len(outputs)))
+
+
+def legacy_stroke_xml(strokes, concept="sketch"):
+    # stroke_data as the API used to build it: ElementTree -> tostring -> minidom re-parse -> pretty-print
+    strokes_list, t_values_list = strokes.to_lists()
+    root = ET.Element("answer")
+    ET.SubElement(root, "concept").text = concept
+    strokes_elem = ET.SubElement(root, "strokes")
+    for i, (points, t_values) in enumerate(zip(strokes_list, t_values_list)):
+        stroke_elem = ET.SubElement(strokes_elem, f"s{i + 1}")
+        ET.SubElement(stroke_elem, "points").text = ", ".join([f"'{p}'" for p in points])
+        ET.SubElement(stroke_elem, "t_values").text = ", ".join([str(t) for t in t_values])
+        ET.SubElement(stroke_elem, "id").text = strokes.ids[i]
+    return minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+
+
+def bench_stroke_data(number=500):
+    strokes = sample_sketch()
+    xml = legacy_stroke_xml(strokes)
+    as_json = json.dumps(utils.format_stroke_data(strokes, "json", "sketch"))
+    as_binary = json.dumps(utils.format_stroke_data(strokes, "binary"))
+    report("stroke_data json", lambda: legacy_stroke_xml(strokes),
+           lambda: json.dumps(utils.format_stroke_data(strokes, "json", "sketch")), number)
+    report("stroke_data binary", lambda: legacy_stroke_xml(strokes),
+           lambda: json.dumps(utils.format_stroke_data(strokes, "binary")), number)
+    # decoding stands in for the client's parse
+    report("decode json", lambda: minidom.parseString(xml), lambda: json.loads(as_json), number)
+    report("decode binary", lambda: minidom.parseString(xml),
+           lambda: utils.StrokeBuffer.from_bytes(base64.b64decode(json.loads(as_binary))), number)
+    for name, payload in (("xml", xml), ("json", as_json), ("binary", as_binary)):
+        print(f"{'stroke_data size ' + name:<28} {len(payload):7d} bytes  ({len(payload) / len(xml):.0%} of xml)")
+
+
+def bench_render(number=20):
+    strokes = sample_sketch()
+    control_points = utils.get_control_points(strokes, None, utils.CellGrid(50, 12), fit_mode="adaptive")
+    dim = (612, 612)
+    native = lambda: utils.render_strokes(control_points, dim, 7.0)
+    for supersample in (2, 3, 4):
+        t_native = timeit.timeit(lambda: utils.render_strokes(control_points, dim, 7.0, supersample=supersample), number=number) / number
+        print(f"{'render native ' + str(supersample) + 'x':<28} new {t_native * 1e6:9.1f} us")
+    try:
+        import cairosvg
+    except (ImportError, OSError):  # OSError: the package is installed but libcairo is missing
+        print(f"{'render vs cairosvg':<28} skipped (cairosvg not available)")
+        return
+    svg = utils.format_svg(control_points, dim, 7.0).encode()
+    report("render vs cairosvg", lambda: cairosvg.svg2png(bytestring=svg, background_color="white"), native, number)
+
+
+def bench_encode(number=20):
+    # sketches as they are saved: on white (and in a collab ink), and on the grid canvas the model sees;
+    # the "legacy" column is the plain "rgb" encoding
+    strokes = sample_sketch()
+    control_points = utils.get_control_points(strokes, None, utils.CellGrid(50, 12), fit_mode="adaptive")
+    dim = (612, 612)
+    on_canvas = utils.get_grid_artifacts(res=50, cell_size=12, header_size=12).canvas()
+    utils.paint_coverage(on_canvas, *utils.strokes_coverage(control_points, 7.0, dim), "black")
+    images = {"white": utils.render_strokes(control_points, dim, 7.0), "green": utils.render_strokes(control_points, dim, 7.0, stroke_colors="green"),
+              "canvas": on_canvas}
+    for name, image in images.items():
+        for encoding in ("palette", "1bit"):
+            report(f"encode_png {encoding} {name}", lambda: utils.encode_png(image, "rgb"), lambda: utils.encode_png(image, encoding), number)
+        sizes = {encoding: len(utils.encode_png(image, encoding)) for encoding in utils.PNG_ENCODINGS}
+        print(f"{'png size ' + name:<28} " + "   ".join(f"{encoding} {size:7d} bytes" for encoding, size in sizes.items()))
+
+
+if __name__ == "__main__":
+    bench_svg()
+    bench_fit()
+    bench_stroke_data()
+    bench_render()
+    bench_encode()
+    bench_parse()  # last: it needs recorded runs and raises without them
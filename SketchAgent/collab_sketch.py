@@ -1,6 +1,5 @@
 import utils
 import math
-import ast
 import cairosvg
 import os
 from dotenv import load_dotenv
@@ -16,6 +15,7 @@ from datetime import datetime
 import traceback
 import uuid
 from PIL import Image
+from io import BytesIO
 
 
 class SketchApp:
@@ -23,7 +23,7 @@ class SketchApp:
     A Python class that manages the interactive drawing process.
     This class should be used when a sketching session is initialized. Here, we keep track on the sketching history, and call our sketching agent to draw sequential strokes with the user.
     """
-    def __init__(self, res, cell_size, grid_size, stroke_width, target_concept, user_always_first):
+    def __init__(self, res, cell_size, grid_size, stroke_width, target_concept, user_always_first, fit_mode="lstsq", fit_tolerance=utils.FIT_TOLERANCE, preprocess_strokes=True, svg_profile="default"):
         self.app = Flask(__name__)
         self.session_id = str(uuid.uuid4())
 
@@ -41,10 +41,15 @@ class SketchApp:
         self.num_cells = res
         self.cell_size = cell_size
         self.grid_size = grid_size
-        self.init_canvas_grid, self.positions = utils.create_grid_image(res=res, cell_size=cell_size, header_size=cell_size)
+        grid = utils.get_grid_artifacts(res=res, cell_size=cell_size, header_size=cell_size)
+        self.init_canvas_grid, self.positions = grid.canvas(), grid.cells_to_pixels
         self.init_canvas = Image.new('RGB', self.grid_size, 'white')
         self.init_canvas.save("static/init_canvas.png")
         self.stroke_width = stroke_width
+        # fit_mode is "lstsq", "adaptive" or "catmull_rom"; preprocess turns repeated-cell corners and straight pieces into lines
+        self.fit_args = {"fit_mode": fit_mode, "tolerance": fit_tolerance, "preprocess": preprocess_strokes}
+        # svg_profile is "default" or "compact" (quantized relative paths, stroke style set once on the <svg> root)
+        self.svg_profile = svg_profile
         self.num_sampled_points = 100
 
         # Program init
@@ -93,7 +98,11 @@ class SketchApp:
 
     def initialize_all(self):
         self.input_prompt = sketch_first_prompt.format(concept=self.target_concept, gt_sketches_str=gt_example)
-        self.all_strokes_svg = f"""<svg width="{self.grid_size[0]}" height="{self.grid_size[1]}" xmlns="http://www.w3.org/2000/svg">"""
+        self.all_strokes_svg = utils.format_svg_header(self.grid_size, self.stroke_width, profile=self.svg_profile)
+        # live raster of the strokes drawn so far; each new stroke is composited onto it instead of re-rendering the SVG
+        self.canvas_surface = utils.RasterSurface(self.grid_size, self.stroke_width)
+        self.last_stroke = None
+        self.sketch_svg_in_sync = False  # sketch.svg holds exactly all_strokes_svg, so strokes can be appended to it
         self.assitant_history = ""
         self.stroke_counter = 0
         self.setup_path2save()
@@ -119,7 +128,7 @@ class SketchApp:
         self.all_strokes_svg += "</svg>"
         with open(f"{self.path2save}/final_sketch.svg", "w") as svg_file:
             svg_file.write(self.all_strokes_svg)
-        cairosvg.svg2png(url=f"{self.path2save}/final_sketch.svg", write_to=f"{self.path2save}/final_sketch.png", background_color="white")
+        self.render_svg_to_png(self.all_strokes_svg, f"{self.path2save}/final_sketch.png")
         print(f"results saved to [{self.path2save}/final_sketch.svg]")
         # Load the existing JSON data
         with open(f"{self.path2save}/data_history.json", "r") as f:
@@ -189,12 +198,11 @@ class SketchApp:
                 return jsonify({"message": str(e), "status": "error"}), 400
             
             self.all_strokes_svg += user_stroke_svg
-            cur_svg_to_render = f"{self.all_strokes_svg}</svg>"
-            with open(f"{self.path2save}/sketch.svg", "w") as svg_file:
-                svg_file.write(cur_svg_to_render)
+            self.append_stroke_svg(user_stroke_svg)
 
-            # 2. Convert the SVG file to PNG (or another image format) using CairoSVG
-            cairosvg.svg2png(url=f"{self.path2save}/sketch.svg", write_to=f"static/cur_canvas_user.png", background_color="white")
+            # 2. Draw only the new stroke onto the live canvas
+            self.canvas_surface.add(*self.last_stroke)
+            self.canvas_surface.save("static/cur_canvas_user.png")
             
             self.update_history(user_stroke)
             if self.sketch_mode == "solo":
@@ -209,17 +217,36 @@ class SketchApp:
 
         
     
+    def render_svg_to_png(self, svg, png_path):
+        # Whole-document renders go through the shared render cache, so re-drawing an unchanged sketch is a lookup
+        svg_bytes = svg.encode("utf-8")
+        png = utils.get_render_cache().get_or_render(svg_bytes, lambda: utils.get_worker_pool().run(cairosvg.svg2png, bytestring=svg_bytes, background_color="white"), background="white")
+        utils.save_png(Image.open(BytesIO(png)), png_path)
+
+    def append_stroke_svg(self, stroke_svg):
+        # Insert the stroke group before the closing </svg> of sketch.svg instead of rewriting the whole document;
+        # the first stroke of a session (or a file this session did not write) gets the full document
+        svg_path = f"{self.path2save}/sketch.svg"
+        if not self.sketch_svg_in_sync or not os.path.exists(svg_path):
+            with open(svg_path, "w") as svg_file:
+                svg_file.write(f"{self.all_strokes_svg}</svg>")
+            self.sketch_svg_in_sync = True
+            return
+        with open(svg_path, "rb+") as svg_file:
+            svg_file.seek(-len(b"</svg>"), os.SEEK_END)
+            svg_file.write(stroke_svg.encode("utf-8") + b"</svg>")
+
     def call_agent(self):
         print("Calling LLM...!")
         try:
             model_stroke_svg = self.predict_next_stroke()
             self.all_strokes_svg += model_stroke_svg
             self.cur_svg_to_render = f"{self.all_strokes_svg}</svg>"
-            with open(f"{self.path2save}/sketch.svg", "w") as svg_file:
-                svg_file.write(self.cur_svg_to_render)
-            cairosvg.svg2png(url=f"{self.path2save}/sketch.svg", write_to=f"static/cur_canvas_agent.png", background_color="white")
+            self.append_stroke_svg(model_stroke_svg)
+            self.canvas_surface.add(*self.last_stroke)
+            self.canvas_surface.save("static/cur_canvas_agent.png")
             if not self.user_always_first:
-                cairosvg.svg2png(url=f"{self.path2save}/sketch.svg", write_to=f"static/init_canvas.png", background_color="white")
+                self.canvas_surface.save("static/init_canvas.png")
             return jsonify({"status": "success", "SVG": self.cur_svg_to_render})
         
         except Exception as e:
@@ -455,20 +482,20 @@ class SketchApp:
         )
 
         # Parse model_rep with xml
-        strokes_list_str, t_values_str = utils.parse_xml_string(all_sketch, res=self.res)
-        strokes_list, t_values = ast.literal_eval(strokes_list_str), ast.literal_eval(t_values_str)
+        strokes = utils.salvage_strokes(all_sketch, res=self.res).strokes
         
         # extract control points from sampled lists
-        all_control_points = utils.get_control_points(strokes_list, t_values, self.positions)
+        all_control_points = utils.fit_runner(utils.get_worker_pool(), len(strokes))(utils.get_control_points, strokes, None, self.positions, **self.fit_args)
 
         # define SVG based on control point
-        sketch_text_svg = utils.format_svg(all_control_points, dim=self.grid_size, stroke_width=self.stroke_width)
+        sketch_text_svg = utils.format_svg(all_control_points, dim=self.grid_size, stroke_width=self.stroke_width, profile=self.svg_profile)
         
-        with open(f"{self.path2save}/sketch.svg", "w") as svg_file:
+        # its own file: sketch.svg is the turn-by-turn sketch that append_stroke_svg extends
+        with open(f"{self.path2save}/entire_sketch.svg", "w") as svg_file:
             svg_file.write(sketch_text_svg)
 
         # 2. Convert the SVG file to PNG (or another image format) using CairoSVG
-        cairosvg.svg2png(url=f"{self.path2save}/sketch.svg", write_to=f"static/entire_sketch.png", background_color="white")
+        self.render_svg_to_png(sketch_text_svg, "static/entire_sketch.png")
 
         return jsonify({"status": "success", "message": "Sketch drawn!"})
 
@@ -488,12 +515,14 @@ class SketchApp:
 
     
     def parse_model_to_svg(self, stroke_model):
-        # Parse model_rep with xml
-        strokes_list_str, t_values_str = utils.parse_xml_string_single_stroke(stroke_model, res=self.res, stroke_counter=self.stroke_counter)
-        strokes_list, t_values = ast.literal_eval(strokes_list_str), ast.literal_eval(t_values_str)
+        # Parse model_rep with xml (model strokes arrive already parsed by the stream parser)
+        if isinstance(stroke_model, utils.StrokeBuffer):
+            stroke = stroke_model
+        else:
+            stroke = utils.parse_stroke(stroke_model, res=self.res, stroke_counter=self.stroke_counter)
         
-        # extract control points from sampled lists
-        all_control_points = utils.get_control_points_single_stroke(strokes_list, t_values, self.positions)
+        # extract control points from sampled lists (a single stroke fits faster in this thread than through the pool)
+        all_control_points = utils.get_control_points_single_stroke(stroke, None, self.positions, **self.fit_args)
 
         # define SVG based on control point
         stroke_color = "green"
@@ -504,7 +533,8 @@ class SketchApp:
             else:
                 if self.stroke_counter % 2 == 1:
                     stroke_color = "pink"
-        sketch_text_svg = utils.format_svg_single_stroke(all_control_points, dim=self.grid_size, stroke_width=self.stroke_width, stroke_counter=self.stroke_counter,stroke_color=stroke_color)
+        sketch_text_svg = utils.format_svg_single_stroke(all_control_points, dim=self.grid_size, stroke_width=self.stroke_width, stroke_counter=self.stroke_counter,stroke_color=stroke_color, profile=self.svg_profile)
+        self.last_stroke = (all_control_points, stroke_color)  # drawn onto canvas_surface once the stroke is accepted
         return sketch_text_svg
 
     def verify_llm_ouput(self, llm_output):
@@ -526,6 +556,7 @@ class SketchApp:
         
         msg_history = []
         init_canvas_str = None # in case we don't want to insert the empty canvas to the model
+        prefill_msg = self.assitant_history.strip()
 
         all_llm_output = self.get_response_from_llm(
             msg=self.input_prompt,
@@ -534,14 +565,18 @@ class SketchApp:
             init_canvas_str=None,
             seed_mode=seed_mode,
             gen_mode=gen_mode,
-            prefill_msg=self.assitant_history.strip(),
+            prefill_msg=prefill_msg,
             **add_args
         )
         self.verify_llm_ouput(all_llm_output) # this will raise an error
 
         all_llm_output += f"</s{self.stroke_counter}>"
         self.update_history(all_llm_output, replace=True)
-        cur_stroke = utils.get_cur_stroke_text(self.stroke_counter, all_llm_output)
+        # only the new completion is parsed, not the whole history it was prefilled with
+        strokes = dict(utils.StrokeStreamParser(self.res).feed(all_llm_output[len(prefill_msg):]))
+        cur_stroke = strokes.get(f"s{self.stroke_counter}")
+        if cur_stroke is None:
+            raise Exception(f"No <s{self.stroke_counter}> stroke in the model output!")
         return cur_stroke
 
 
@@ -596,12 +631,16 @@ if __name__ == '__main__':
     cell_size = 12
     grid_size = (612,612)
     stroke_width = cell_size * 0.6
+    fit_mode = "catmull_rom"  # closed-form curves through every cell the user touched; "lstsq" / "adaptive" fit the t-values instead
+    svg_profile = "compact"
 
     sketch_app = SketchApp(res=res, 
                             cell_size=cell_size,
                             grid_size=grid_size,
                             stroke_width=stroke_width,
                             target_concept="sailboat",
-                            user_always_first=user_always_first)
+                            user_always_first=user_always_first,
+                            fit_mode=fit_mode,
+                            svg_profile=svg_profile)
     
     sketch_app.run(hostname, ip_address)
\ No newline at end of file
@@ -3,7 +3,6 @@ from flask_cors import CORS
 import os
 import argparse
 import anthropic
-import ast
 import cairosvg
 import json
 import utils
@@ -11,10 +10,10 @@ import traceback
 from datetime import datetime
 import uuid
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 
 from dotenv import load_dotenv
 from PIL import Image
+from io import BytesIO
 from prompts import sketch_first_prompt, system_prompt, gt_example
 
 app = Flask(__name__)  # This line defines the app
@@ -36,6 +35,20 @@ def call_argparse():
     parser.add_argument('--cell_size', type=int, default=12, help="size of each cell in the grid")
     parser.add_argument('--stroke_width', type=float, default=7.0)
 
+    # Curve fitting params
+    parser.add_argument('--fit_mode', type=str, default='adaptive', choices=['lstsq', 'adaptive', 'catmull_rom'])
+    parser.add_argument('--fit_tolerance', type=float, default=6.0, help="max distance (px) of a sampled point from its curve in adaptive mode")
+    parser.add_argument('--stroke_preprocess', type=str, default='corners', choices=['none', 'corners', 'runs'], help="collapse repeated cells into corners and straight lines before fitting")
+
+    # SVG output params
+    parser.add_argument('--svg_profile', type=str, default='compact', choices=['default', 'compact'], help="compact quantizes coordinates, uses relative path commands and shares the stroke style")
+    parser.add_argument('--svg_precision', type=int, default=None, help="decimals kept in path coordinates (default: 2 for 'default', 1 for 'compact')")
+    parser.add_argument('--raster_backend', type=str, default='cairosvg', choices=['cairosvg', 'native'], help="native draws the fitted curves directly instead of rendering the SVG file")
+    parser.add_argument('--png_encoding', type=str, default='palette', choices=['rgb', 'palette', '1bit'], help="palette / 1bit store the line-art PNGs with a few coverage levels per stroke color")
+
+    # Malformed output
+    parser.add_argument('--tail_attempts', type=int, default=1, help="how many times to ask the model for only the missing strokes when its output is cut off")
+
     args = parser.parse_args()
     args.grid_size = (args.res + 1) * args.cell_size
 
@@ -76,6 +89,18 @@ def create_args_for_concept(concept):
     args.stroke_width = 7.0
     args.grid_size = (args.res + 1) * args.cell_size
 
+    # Curve fitting params
+    args.fit_mode = 'adaptive'
+    args.fit_tolerance = 6.0
+    args.stroke_preprocess = 'corners'
+
+    # SVG output params
+    args.svg_profile = 'compact'
+    args.svg_precision = None
+    args.raster_backend = 'cairosvg'
+    args.png_encoding = 'palette'
+    args.tail_attempts = 1
+
     args.save_name = args.concept_to_draw.replace(" ", "_")
     args.path2save = f"{args.path2save}/{args.save_name}"
 
@@ -205,29 +230,41 @@ def get_response_from_llm(
         return content, new_msg_history
 
 
-def save_sketch(model_strokes_svg, output_path, add_object, init_canvas):
-    with open(f"{output_path}/output_{add_object}.svg", "w") as svg_file:
-        svg_file.write(model_strokes_svg)
+def render_sketch(model_strokes_svg, canvas=None, stroke_layer=None):
+    """
+    Rasterize the SVG once, in memory, and derive both outputs from that single surface.
+    Returns the strokes on a white background and, if a canvas is given, on a copy of that canvas.
+    stroke_layer is an optional transparent RGBA rendering of the strokes (e.g. utils.render_strokes with background=None), used instead of cairosvg.
+    """
+    if stroke_layer is None:
+        # identical SVGs (deterministic generations, replayed edits) are a cache lookup instead of a cairosvg call
+        svg_bytes = model_strokes_svg.encode("utf-8")
+        png = utils.get_render_cache().get_or_render(svg_bytes, lambda: utils.get_worker_pool().run(cairosvg.svg2png, bytestring=svg_bytes))
+        stroke_layer = Image.open(BytesIO(png)).convert("RGBA")
 
-    # Save the result with clean white background (no grid)
-    cairosvg.svg2png(url=f"{output_path}/output_{add_object}.svg",
-                     write_to=f"{output_path}/output_{add_object}.png",
-                     background_color="white")
+    on_white = Image.new('RGB', stroke_layer.size, 'white')
+    on_white.paste(stroke_layer, (0, 0), stroke_layer)
+
+    on_canvas = None
+    if canvas is not None:
+        on_canvas = canvas.convert('RGB')
+        on_canvas.paste(stroke_layer, (0, 0), stroke_layer)
+    return on_white, on_canvas
 
-    if init_canvas is not None:
-        # For the canvas version, create a blank white canvas instead of using the grid
-        output_png_path = f"{output_path}/output_{add_object}_canvas.png"
 
-        # Create a blank white image with the same dimensions as init_canvas
-        blank_canvas = Image.new('RGB', init_canvas.size, 'white')
+def save_sketch(model_strokes_svg, output_path, add_object, init_canvas, stroke_layer=None, write_files=True, png_encoding=utils.PNG_ENCODING):
+    # The canvas version is also drawn on a blank white canvas (no grid), so one white composite serves both files
+    sketch_rendered, _ = render_sketch(model_strokes_svg, stroke_layer=stroke_layer)
 
-        # Convert SVG to PNG and overlay on blank canvas
-        cairosvg.svg2png(url=f"{output_path}/output_{add_object}.svg", write_to=output_png_path)
-        foreground = Image.open(output_png_path)
-        blank_canvas.paste(foreground, (0, 0), foreground)
-        blank_canvas.save(output_png_path)
+    if write_files:
+        with open(f"{output_path}/output_{add_object}.svg", "w") as svg_file:
+            svg_file.write(model_strokes_svg)
+        utils.save_png(sketch_rendered, f"{output_path}/output_{add_object}.png", png_encoding)
+        if init_canvas is not None:
+            utils.save_png(sketch_rendered, f"{output_path}/output_{add_object}_canvas.png", png_encoding)
 
-        return blank_canvas
+    if init_canvas is not None:
+        return sketch_rendered
 
     # # save the result also without the canvas background
     # cairosvg.svg2png(url=f"{output_path}/output_{add_object}.svg", write_to=f"{output_path}/output_{add_object}.png", background_color="white")
@@ -242,6 +279,19 @@ def save_sketch(model_strokes_svg, output_path, add_object, init_canvas):
     #     init_canvas_copy.save(output_png_path)
     #     return init_canvas_copy
 
+def rasterize_fitted_sketch(sketch, canvas=None, raster_backend="cairosvg"):
+    """render_sketch for a utils.FittedSketch: native draws its control points, cairosvg renders its SVG."""
+    stroke_layer = sketch.render(background=None, pool=utils.get_worker_pool()) if raster_backend == "native" else None
+    return render_sketch(sketch.svg(), canvas=canvas, stroke_layer=stroke_layer)
+
+
+def format_stroke_xml(root):
+    # Indented like minidom's toprettyxml(indent="  ") without serializing and re-parsing the tree; the text is
+    # XML-equivalent, not byte-identical (empty elements come out as <s2 /> and quotes in text stay unescaped)
+    ET.indent(root, space="  ")
+    return '<?xml version="1.0" ?>\n' + ET.tostring(root, encoding="unicode") + "\n"
+
+
 class SketchApp:
     def __init__(self, args):
         # General
@@ -255,12 +305,31 @@ class SketchApp:
         self.num_cells = args.res
         self.cell_size = args.cell_size
         self.grid_size = (args.grid_size, args.grid_size)
-        self.init_canvas, self.positions = utils.create_grid_image(res=args.res, cell_size=args.cell_size, header_size=args.cell_size)
-        self.init_canvas_str = utils.image_to_str(self.init_canvas)
-        self.cells_to_pixels_map = utils.cells_to_pixels(args.res, args.cell_size, header_size=args.cell_size)
+        # grid image, cell map and encoded canvas are built once per process and shared; init_canvas is our own copy
+        grid = utils.get_grid_artifacts(res=args.res, cell_size=args.cell_size, header_size=args.cell_size)
+        self.init_canvas, self.positions = grid.canvas(), grid.cells_to_pixels
+        self.init_canvas_str = grid.image_str
+        self.cells_to_pixels_map = grid.cells_to_pixels
 
         # SVG related
         self.stroke_width = args.stroke_width
+        stroke_preprocess = getattr(args, 'stroke_preprocess', 'corners')
+        self.fit_args = {
+            "fit_mode": getattr(args, 'fit_mode', 'adaptive'),
+            "tolerance": getattr(args, 'fit_tolerance', utils.FIT_TOLERANCE),
+            "preprocess": False if stroke_preprocess == 'none' else stroke_preprocess,  # "corners" or "runs"
+        }
+        self.svg_args = {
+            "profile": getattr(args, 'svg_profile', 'compact'),
+            "precision": getattr(args, 'svg_precision', None),
+        }
+        self.raster_backend = getattr(args, 'raster_backend', 'cairosvg')
+        self.sketch_rendered = None  # last generated sketch on a white background
+        self.sketch_on_canvas = None  # and on the grid canvas
+        self.fitted_sketch = None  # and its strokes (utils.FittedSketch)
+        self.png_encoding = getattr(args, 'png_encoding', utils.PNG_ENCODING)
+        self.tail_attempts = getattr(args, 'tail_attempts', 1)
+        self.salvage = None  # utils.SalvagedStrokes of the last generation
 
         # LLM Setup (you need to provide your ANTHROPIC_API_KEY in your .env file)
         self.cache = False
@@ -407,47 +476,78 @@ class SketchApp:
             # Return a fallback output
             return self.get_default_stroke_data()
 
-    def parse_model_to_svg(self, model_rep_sketch):
-        # Parse model_rep with xml
-        strokes_list_str, t_values_str = utils.parse_xml_string(model_rep_sketch, self.res)
-        strokes_list, t_values = ast.literal_eval(strokes_list_str), ast.literal_eval(t_values_str)
-
-        # extract control points from sampled lists
-        all_control_points = utils.get_control_points(strokes_list, t_values, self.cells_to_pixels_map)
+    def salvage_model_sketch(self, llm_output, **llm_args):
+        """
+        Keep every well-formed stroke of llm_output. If the output was cut off (e.g. at max_tokens), ask the model to
+        continue from the last good stroke, up to self.tail_attempts times. llm_args are the get_response_from_llm
+        arguments of the original call. Returns the (possibly extended) output and its utils.SalvagedStrokes.
+        Raises ValueError if no stroke could be salvaged.
+        """
+        salvage = utils.salvage_strokes(llm_output, self.res)
+        for _ in range(self.tail_attempts):
+            if salvage.complete or salvage.resume_text is None:  # done, or no <strokes> block to continue
+                break
+            print(f"Output cut off after {len(salvage.strokes)} strokes, requesting the missing tail...")
+            llm_args.update(gen_mode="completion", prefill_msg=salvage.resume_text.rstrip(), stop_sequences="</answer>")
+            llm_output = self.get_response_from_llm(**llm_args) + "</answer>"
+            salvage = utils.salvage_strokes(llm_output, self.res)
+        if salvage.dropped:
+            print(f"Dropped strokes: {salvage.dropped}")
+        if not len(salvage.strokes):
+            raise ValueError(f"No strokes could be salvaged from the model output (dropped: {salvage.dropped})")
+        return llm_output, salvage
+
+    def fit_model_sketch(self, model_rep_sketch):
+        # Parse model_rep with xml (unless given already parsed strokes) and fit control points to the sampled lists
+        strokes = model_rep_sketch if isinstance(model_rep_sketch, utils.StrokeBuffer) else utils.salvage_strokes(model_rep_sketch, self.res).strokes
+        sketch = utils.FittedSketch(self.cells_to_pixels_map, dim=self.grid_size, stroke_width=self.stroke_width, fit_args=self.fit_args, svg_args=self.svg_args)
+        sketch.add(strokes, pool=utils.get_worker_pool())
+        return sketch
 
+    def parse_model_to_svg(self, model_rep_sketch):
         # define SVG based on control point
-        sketch_text_svg = utils.format_svg(all_control_points, dim=self.grid_size, stroke_width=self.stroke_width)
-        return sketch_text_svg
+        return self.fit_model_sketch(model_rep_sketch).svg()
 
-    def generate_sketch(self):
+    def generate_sketch(self, save_files=True, render=True, stroke_format="xml"):
+        """
+        render=False only fits the strokes (self.fitted_sketch) and writes the SVG;
+        the raster files are then produced later by rasterize_sketch().
+        stroke_format is one of utils.STROKE_DATA_FORMATS and selects the returned stroke data.
+        """
         # Call the LLM to get sketching commands
         sketching_commands = self.call_model_for_sketch_generation()
+        # A truncated or partly malformed answer keeps its good strokes; only a cut-off tail is requested again
+        sketching_commands, self.salvage = self.salvage_model_sketch(
+            sketching_commands, msg=self.input_prompt, system_message=system_prompt.format(res=self.res),
+            msg_history=[], init_canvas_str=None, seed_mode=self.seed_mode)
 
         # Parse the commands to get strokes
-        model_strokes_svg = self.parse_model_to_svg(sketching_commands)
-
-        # Save the SVG sketch
-        svg_path = f"{self.path2save}/{self.save_name}.svg"
-        with open(svg_path, "w") as svg_file:
-            svg_file.write(model_strokes_svg)
-
-        # Convert to PNG
-        png_path = f"{self.path2save}/{self.save_name}.png"
-        cairosvg.svg2png(url=svg_path, write_to=png_path, background_color="white")
-
-        # Save with canvas background
-        canvas_png_path = f"{self.path2save}/{self.save_name}_canvas.png"
-        cairosvg.svg2png(url=svg_path, write_to=canvas_png_path)
-        foreground = Image.open(canvas_png_path)
-        self.init_canvas.paste(Image.open(canvas_png_path), (0, 0), foreground)
-        self.init_canvas.save(canvas_png_path)
-
-        # Generate stroke data in XML format
-        stroke_data = self.extract_stroke_data_from_llm_output(sketching_commands)
-        return stroke_data
-
-    def extract_stroke_data_from_llm_output(self, llm_output):
-        """Extract stroke data from LLM output and format as XML."""
+        sketch = self.fit_model_sketch(self.salvage.strokes)
+        self.fitted_sketch = sketch
+
+        if save_files:
+            with open(f"{self.path2save}/{self.save_name}.svg", "w") as svg_file:
+                svg_file.write(sketch.svg())
+        if render:
+            self.rasterize_sketch(save_files)
+
+        # Generate stroke data in XML format, or straight from the parsed strokes in a compact one
+        if stroke_format == "xml":
+            return self.extract_stroke_data_from_llm_output(sketching_commands, salvage=self.salvage)
+        return utils.format_stroke_data(self.salvage.strokes, stroke_format, self.target_concept)
+
+    def rasterize_sketch(self, save_files=True):
+        # Render once, in memory: on white and on the grid canvas the model sees
+        # render_sketch composites onto a copy, so init_canvas stays the clean grid for the next generation
+        self.sketch_rendered, self.sketch_on_canvas = rasterize_fitted_sketch(self.fitted_sketch, canvas=self.init_canvas, raster_backend=self.raster_backend)
+
+        if save_files:
+            utils.save_png(self.sketch_rendered, f"{self.path2save}/{self.save_name}.png", self.png_encoding)
+            utils.save_png(self.sketch_on_canvas, f"{self.path2save}/{self.save_name}_canvas.png", self.png_encoding)
+        return self.sketch_rendered
+
+    def extract_stroke_data_from_llm_output(self, llm_output, salvage=None):
+        """Extract stroke data from LLM output and format as XML. salvage: the output's utils.SalvagedStrokes, if already parsed."""
         try:
             # Aggressive debugging - print EXACTLY what was received
             print("RAW LLM OUTPUT (START)")
@@ -464,27 +564,15 @@ class SketchApp:
             # Create strokes element
             strokes_elem = ET.SubElement(root, "strokes")
 
-            import re
-
-            # Pattern to match entire stroke sections
-            stroke_pattern = r'<s(\d+)>\n*\s*<points>(.*?)</points>\n*\s*<t_values>(.*?)</t_values>\n*\s*<id>(.*?)</id>\n*\s*</s\1>'
-
-            # Find all stroke matches
-            stroke_matches = re.findall(stroke_pattern, llm_output, re.DOTALL | re.IGNORECASE)
+            # Same tolerant parse the sketch was fitted from: malformed strokes are skipped, not the whole answer
+            if salvage is None:
+                salvage = utils.salvage_strokes(llm_output, self.res)
+            strokes_list, t_values_list = salvage.strokes.to_lists()
 
             stroke_count = 0
-            for match in stroke_matches:
-                stroke_num, points, t_values, stroke_id = match
-
-                # Clean and process points
-                point_pattern = r"'(x\d+y\d+)'"
-                parsed_points = re.findall(point_pattern, points)
-
-                # Clean and process t-values
-                parsed_t_values = [val.strip() for val in t_values.split(',')]
-
+            for tag, parsed_points, parsed_t_values, stroke_id in zip(salvage.tags, strokes_list, t_values_list, salvage.strokes.ids):
                 # Create stroke element
-                stroke_elem = ET.SubElement(strokes_elem, f"s{stroke_num}")
+                stroke_elem = ET.SubElement(strokes_elem, tag)
 
                 # Add points
                 points_elem = ET.SubElement(stroke_elem, "points")
@@ -492,7 +580,7 @@ class SketchApp:
 
                 # Add t-values
                 t_values_elem = ET.SubElement(stroke_elem, "t_values")
-                t_values_elem.text = ", ".join(parsed_t_values)
+                t_values_elem.text = ", ".join([str(t) for t in parsed_t_values])
 
                 # Add ID
                 id_elem = ET.SubElement(stroke_elem, "id")
@@ -518,7 +606,7 @@ class SketchApp:
             print(f"Number of strokes extracted: {stroke_count}")
 
             # Format the XML nicely
-            xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+            xml_str = format_stroke_xml(root)
             print("Generated Stroke XML:", xml_str)  # Add this for debugging
             return xml_str
 
@@ -548,7 +636,7 @@ class SketchApp:
         id1.text = "outline"
 
         # Format the XML nicely
-        xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+        xml_str = format_stroke_xml(root)
         return xml_str
 
     def get_stroke_data(self):
@@ -575,14 +663,17 @@ class SketchApp:
         id1.text = "building base"
 
         # Format the XML nicely
-        xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+        xml_str = format_stroke_xml(root)
         return xml_str
 
 
-    def edit_sketch_in_chat_add(self, path_to_data, object_to_edit, add_objects, reflection_prompt, cache=True, seed_mode="deterministic"):
+    def edit_sketch_in_chat_add(self, path_to_data, object_to_edit, add_objects, reflection_prompt, cache=True, seed_mode="deterministic", stroke_format="xml", first_stroke=0, base_sketch=None):
         """
         Method to edit an existing sketch by adding new objects incrementally.
         Each object is added separately and strokes are accumulated.
+        The returned stroke data covers the strokes from index first_stroke on (a delta when the client holds the rest).
+        base_sketch is the utils.FittedSketch of the sketch being edited, if the caller kept it: when it holds exactly the
+        loaded strokes with the same fit settings, it is extended (as a copy) instead of re-fitting every base stroke.
         """
         output_path = f"{path_to_data}/{object_to_edit}/editing_add"
         if not os.path.exists(output_path):
@@ -595,9 +686,16 @@ class SketchApp:
             json.dump(system_message_json + msg_history, json_file, indent=4)
 
         # Save given strokes
-        prev_strokes_list_str, prev_t_values_str = utils.parse_xml_string(assistant_prompt, res=self.res)
-        accum_strokes_list, accum_t_values = ast.literal_eval(prev_strokes_list_str), ast.literal_eval(prev_t_values_str)
+        # Fitted control points and SVG groups are kept per stroke, so each edit only fits the strokes it adds
+        base_strokes = utils.salvage_strokes(assistant_prompt, res=self.res).strokes
+        if (base_sketch is not None and len(base_sketch) == len(base_strokes) and base_sketch.strokes.starts_with(base_strokes)
+                and (base_sketch.fit_args, base_sketch.svg_args, base_sketch.stroke_width) == (self.fit_args, self.svg_args, self.stroke_width)):
+            sketch = base_sketch.copy()
+        else:
+            sketch = utils.FittedSketch(self.cells_to_pixels_map, dim=self.grid_size, stroke_width=self.stroke_width, fit_args=self.fit_args, svg_args=self.svg_args)
+            sketch.add(base_strokes, pool=utils.get_worker_pool())
         cur_sketch_str = utils.image_to_str(sketch_rendered)
+        dropped_strokes = []
 
         # Add objects in a loop
         for add_object in add_objects:
@@ -612,15 +710,17 @@ class SketchApp:
                         gen_mode=self.gen_mode
                     )
 
-            strokes_list_str, t_values_str = utils.parse_xml_string(all_llm_output, res=self.res)
-            strokes_list, t_values = ast.literal_eval(strokes_list_str), ast.literal_eval(t_values_str)
+            all_llm_output, salvage = self.salvage_model_sketch(
+                all_llm_output, msg=user_edit_prompt, system_message=system_prompt, msg_history=msg_history,
+                init_canvas_str=cur_sketch_str, seed_mode=seed_mode)
+            strokes = salvage.strokes
+            dropped_strokes += [(add_object, tag, reason) for tag, reason in salvage.dropped]
 
             # This is the part where we add the new strokes to existing ones:
-            accum_strokes_list.extend(strokes_list)
-            accum_t_values.extend(t_values)
-            all_control_points = utils.get_control_points(accum_strokes_list, accum_t_values, self.cells_to_pixels_map)
-            model_strokes_svg = utils.format_svg(all_control_points, dim=self.grid_size, stroke_width=self.stroke_width)
-            sketch_rendered = save_sketch(model_strokes_svg, output_path, add_object, self.init_canvas)
+            sketch.add(strokes, pool=utils.get_worker_pool())
+            model_strokes_svg = sketch.svg()
+            stroke_layer = sketch.render(background=None, pool=utils.get_worker_pool()) if self.raster_backend == "native" else None
+            sketch_rendered = save_sketch(model_strokes_svg, output_path, add_object, self.init_canvas, stroke_layer=stroke_layer, png_encoding=self.png_encoding)
 
             cur_sketch_str = utils.image_to_str(sketch_rendered)
             msg_history = msg_history + [
@@ -638,11 +738,23 @@ class SketchApp:
         # Return final results including the new strokes
         return {
             "final_image": sketch_rendered,
-            "stroke_data": self.format_stroke_data_for_frontend(accum_strokes_list, accum_t_values, object_to_edit, add_objects)
+            "sketch": sketch,
+            "stroke_data": self.format_edit_stroke_data(sketch.strokes, object_to_edit, add_objects, stroke_format, first_stroke),
+            "dropped_strokes": dropped_strokes
         }
 
-    def format_stroke_data_for_frontend(self, strokes_list, t_values, original_concept, added_objects):
-        """Format stroke data in XML format for frontend animation"""
+    def format_edit_stroke_data(self, strokes, original_concept, added_objects, stroke_format="xml", first_stroke=0):
+        """Stroke data of strokes[first_stroke:] in one of utils.STROKE_DATA_FORMATS; XML strokes keep their index in the whole sketch."""
+        strokes = strokes.select(first_stroke) if first_stroke else strokes
+        if stroke_format == "xml":
+            return self.format_stroke_data_for_frontend(strokes, None, original_concept, added_objects, first_index=first_stroke + 1)
+        return utils.format_stroke_data(strokes, stroke_format, f"{original_concept} with {', '.join(added_objects)}")
+
+    def format_stroke_data_for_frontend(self, strokes_list, t_values, original_concept, added_objects, first_index=1):
+        """Format stroke data in XML format for frontend animation. strokes_list may also be a StrokeBuffer (t_values is then ignored)."""
+        if isinstance(strokes_list, utils.StrokeBuffer):
+            strokes_list, t_values = strokes_list.to_lists()
+
         root = ET.Element("answer")
 
         # Add concept
@@ -653,7 +765,7 @@ class SketchApp:
         strokes_elem = ET.SubElement(root, "strokes")
 
         # Add each stroke to the XML
-        for i, (points, t_vals) in enumerate(zip(strokes_list, t_values)):
+        for i, (points, t_vals) in enumerate(zip(strokes_list, t_values), start=first_index - 1):
             stroke_elem = ET.SubElement(strokes_elem, f"s{i+1}")
 
             # Add points
@@ -669,7 +781,7 @@ class SketchApp:
             id_elem.text = f"stroke_{i+1}"
 
         # Format the XML nicely
-        xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+        xml_str = format_stroke_xml(root)
         return xml_str
 
 
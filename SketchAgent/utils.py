@@ -1,7 +1,18 @@
 import xml.etree.ElementTree as ET
 import re
+import math
+import functools
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont
 from io import BytesIO
 import base64
 
@@ -9,95 +20,143 @@ import base64
 # =========================
 # ===== Grid related ======
 # =========================
+@functools.lru_cache(maxsize=None)
+def load_grid_font(header_size=12):
+    try:
+        return ImageFont.truetype("arial.ttf", header_size*0.85)
+    except IOError:
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=4096)
+def grid_label_metrics(text, header_size=12):
+    """(width, height) of a header label, measured once per label and font size."""
+    left, top, right, bottom = load_grid_font(header_size).getbbox(text)
+    return right - left, bottom - top
+
+
 def create_grid_image(res=50, cell_size=12, header_size=12):
     # Define the size of the grid
     rows = res
     cols = res
-    
+
     img_width = (cols + 1) * cell_size
     img_height = (rows + 1) * cell_size
-    
-    # Create a new image with a white background
-    img = Image.new('RGB', (img_width, img_height), 'white')
+    grid_bottom = rows * cell_size  # top edge of the column header strip
+
+    # Draw the header borders straight into the pixel array: the row header column (x in [0, cell_size]) and the
+    # column header strip (y >= grid_bottom), with a border every cell_size pixels. Cell interiors stay white.
+    pixels = np.full((img_height, img_width), 255, dtype=np.uint8)
+    borders = np.arange(res + 1) * cell_size
+    pixels[:grid_bottom + 1, [0, cell_size]] = 0
+    pixels[borders[:rows + 1, None], np.arange(cell_size + 1)] = 0
+    pixels[:, cell_size] = 0
+    pixels[grid_bottom, :] = 0
+    pixels[grid_bottom:, borders[:cols + 1]] = 0
+    img = Image.fromarray(pixels, "L").convert("RGB")
     draw = ImageDraw.Draw(img)
-    
+
     # Load a font
-    try:
-        font = ImageFont.truetype("arial.ttf", header_size*0.85)
-    except IOError:
-        font = ImageFont.load_default()
-    
+    font = load_grid_font(header_size)
+
     # Draw the headers
     for j in range(cols):
         # Draw column header (letters)
-        text = str(j +1)
-        text_bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+        text = str(j + 1)
+        text_width, _ = grid_label_metrics(text, header_size)
         text_x = (j + 1) * cell_size + (cell_size - text_width) / 2
-        text_y = img_height - cell_size # - (cell_size - text_height) / 2
+        text_y = img_height - cell_size
         draw.text((text_x, text_y), text, fill="black", font=font)
-    
+
     for i in range(rows):
         # Draw row header (numbers)
         text = str(rows - i)
-        text_bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+        text_width, text_height = grid_label_metrics(text, header_size)
         text_x = (cell_size - text_width) / 2
         text_y = i * cell_size + (cell_size - text_height) / 2 - 0.2*text_height
         draw.text((text_x, text_y), text, fill="black", font=font)
-    
-    # Draw the grid
-    i = 1
-    draw.line([(i * cell_size, 0), (i * cell_size, img_height)], fill="black")
-    # Horizontal lines
-    draw.line([(0, img_height -  cell_size), (img_width, img_height -  cell_size)], fill="black")
-    
-    positions={}
-    # Draw the grid
-    for i in range(rows)[::-1]:
-        for j in range(cols):
-            # Draw cell border
-            if j == 0:
-                draw.rectangle([(j + 0) * cell_size, (i + 0) * cell_size, (j + 1) * cell_size, (i + 1) * cell_size], outline="black")
-            if i == rows - 1:
-                draw.rectangle([(j + 0) * cell_size, (i + 1) * cell_size, (j + 1) * cell_size, (i + 2) * cell_size], outline="black")
-    
-            # Calculate the position of the text
-            text = f"x{j + 1}y{i + 1}"
-            text_bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            text_height = text_bbox[3] - text_bbox[1]
-            text_x = (j + 1) * cell_size + (cell_size - text_width) / 2
-            text_y = (i + 1) * cell_size + (cell_size - text_height) / 2
-            
-            center_y = int(img_height - cell_size - (i * cell_size) - cell_size / 2)
-            center_x = int(j * cell_size + cell_size / 2 + cell_size)
-            positions[text] = (center_x, center_y)
-    return img, positions
+
+    # Cell centers are closed-form, see CellGrid
+    return img, CellGrid(res, cell_size)
+
+
+class CellGrid(Mapping):
+    """
+    Closed-form map between grid cells and pixel centers of the grid image ('x1y1' is the bottom-left cell).
+    Also behaves as the read-only 'xNyM' -> (center_x, center_y) dictionary that cells_to_pixels used to build.
+    """
+    __slots__ = ("res", "cell_size")
+
+    def __init__(self, res=50, cell_size=12):
+        self.res = res
+        self.cell_size = cell_size
+
+    def to_pixels(self, xy):
+        """Integer grid coordinates (..., 2) -> pixel centers (..., 2)."""
+        xy = np.asarray(xy, dtype=np.int64)
+        half = self.cell_size // 2
+        return np.stack([xy[..., 0] * self.cell_size + half, (self.res - xy[..., 1]) * self.cell_size + half], axis=-1)
+
+    def to_cells(self, pixels):
+        """Pixel coordinates (..., 2) -> integer grid coordinates of the cells containing them."""
+        pixels = np.asarray(pixels)
+        return np.stack([pixels[..., 0] // self.cell_size, self.res - pixels[..., 1] // self.cell_size], axis=-1).astype(np.int64)
+
+    def __getitem__(self, cell):
+        match = CELL_PATTERN.fullmatch(cell) if isinstance(cell, str) else None
+        if match is None:
+            raise KeyError(cell)
+        x, y = int(match.group(1)), int(match.group(2))
+        if not (1 <= x <= self.res and 1 <= y <= self.res):
+            raise KeyError(cell)
+        half = self.cell_size // 2
+        return (x * self.cell_size + half, (self.res - y) * self.cell_size + half)
+
+    def __iter__(self):
+        for i in range(self.res)[::-1]:
+            for j in range(self.res):
+                yield f"x{j + 1}y{i + 1}"
+
+    def __len__(self):
+        return self.res * self.res
 
 
 def cells_to_pixels(res=50, cell_size=12, header_size=12):
-    # Define the size of the grid
-    rows = res
-    cols = res
-    
-    img_width = (cols + 1) * cell_size
-    img_height = (rows + 1) * cell_size
+    return CellGrid(res, cell_size)
+
+
+class GridArtifacts:
+    """
+    Everything derived from one grid configuration: the grid image, its cell map, its base64 JPEG for the LLM and the
+    header font. Shared by every SketchApp in the process, so the grid image itself is never handed out:
+    canvas() returns a private copy that callers may draw on freely.
+    """
+    __slots__ = ("res", "cell_size", "header_size", "cells_to_pixels", "image_str", "font", "_canvas")
 
-    positions={}
-    # Draw the grid
-    for i in range(rows)[::-1]:
-        for j in range(cols):
-            # Calculate the position of the text
-            text = f"x{j + 1}y{i + 1}"
-            
-            center_y = int(img_height - cell_size - (i * cell_size) - cell_size / 2)
-            center_x = int(j * cell_size + cell_size / 2 + cell_size)
-            positions[text] = (center_x, center_y)
+    def __init__(self, res=50, cell_size=12, header_size=12):
+        self.res = res
+        self.cell_size = cell_size
+        self.header_size = header_size
+        self._canvas, self.cells_to_pixels = create_grid_image(res, cell_size, header_size)
+        self.image_str = image_to_str(self._canvas)
+        self.font = load_grid_font(header_size)
 
-    return positions
+    def canvas(self):
+        return self._canvas.copy()
+
+
+_grid_artifacts = {}
+_grid_artifacts_lock = threading.Lock()
+
+
+def get_grid_artifacts(res=50, cell_size=12, header_size=12):
+    """Process-wide, thread-safe cache of GridArtifacts keyed by (res, cell_size, header_size)."""
+    key = (res, cell_size, header_size)
+    with _grid_artifacts_lock:
+        artifacts = _grid_artifacts.get(key)
+        if artifacts is None:
+            artifacts = _grid_artifacts[key] = GridArtifacts(res, cell_size, header_size)
+        return artifacts
 
 
 # =========================
@@ -105,13 +164,149 @@ def cells_to_pixels(res=50, cell_size=12, header_size=12):
 # =========================
 def image_to_str(image: Image):
     buffer = BytesIO()
-    image.save(buffer, format="JPEG")
+    # palette PNGs (see save_png) have to be expanded before JPEG encoding
+    image.convert("RGB").save(buffer, format="JPEG")
     buffer.seek(0)
     image = base64.b64encode(buffer.read()).decode('utf-8')
     return image
 
 
 
+# =====================================
+# ===== Stroke representation =========
+# =====================================
+CELL_PATTERN = re.compile(r"x\s*(\d+)\s*y\s*(\d+)")
+NUMBER_PATTERN = re.compile(r"-?\d*\.?\d+(?:[eE][-+]?\d+)?")
+STROKE_BYTES_MAGIC = b"SKS1"
+# stroke_data formats the API can answer with: the original pretty-printed XML, StrokeBuffer.to_dict() as JSON,
+# or StrokeBuffer.to_bytes() (base64 inside the JSON response)
+STROKE_DATA_FORMATS = ("xml", "json", "binary")
+
+
+class StrokeBuffer:
+    """
+    All strokes of a sketch in contiguous arrays.
+    Stroke i covers xy[offsets[i]:offsets[i + 1]] (int16 grid x, y) with one float32 t-value per point, and is named ids[i].
+    """
+    __slots__ = ("xy", "t_values", "offsets", "ids")
+
+    def __init__(self, xy=None, t_values=None, offsets=None, ids=None):
+        self.xy = np.zeros((0, 2), dtype=np.int16) if xy is None else np.asarray(xy, dtype=np.int16).reshape(-1, 2)
+        self.t_values = np.zeros(0, dtype=np.float32) if t_values is None else np.asarray(t_values, dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+        self.ids = [f"s{i + 1}" for i in range(len(self.offsets) - 1)] if ids is None else list(ids)
+
+    @classmethod
+    def from_arrays(cls, strokes_xy, strokes_t_values, ids=None, res=None):
+        """Build from per-stroke (n, 2) grid coordinates and t-values; t-values that do not match the point count become uniform."""
+        strokes_xy = [np.asarray(xy, dtype=np.int64).reshape(-1, 2) for xy in strokes_xy]
+        counts = [len(xy) for xy in strokes_xy]
+        xy = np.concatenate(strokes_xy) if strokes_xy else np.zeros((0, 2), dtype=np.int64)
+        if res is not None:
+            xy = np.clip(xy, 1, res)
+        t_values = [_stroke_t_values(t, n) for t, n in zip(strokes_t_values, counts)]
+        t_values = np.concatenate(t_values) if t_values else np.zeros(0)
+        return cls(xy, t_values, np.cumsum([0] + counts), ids)
+
+    @classmethod
+    def from_lists(cls, strokes_list, t_values_list, ids=None, res=None):
+        """Build from the list-of-lists format: cell strings ('x12y34') and t-values per stroke."""
+        strokes_xy = [[(int(x), int(y)) for x, y in CELL_PATTERN.findall(" ".join(cells))] for cells in strokes_list]
+        return cls.from_arrays(strokes_xy, t_values_list, ids, res)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.stroke(i)
+
+    def stroke(self, i):
+        """(xy, t_values) views of stroke i."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.xy[start:end], self.t_values[start:end]
+
+    def point_counts(self):
+        return np.diff(self.offsets)
+
+    def cells(self, i):
+        return [f"x{x}y{y}" for x, y in self.stroke(i)[0].tolist()]
+
+    def to_lists(self):
+        """Back to the list-of-lists format (cell strings, rounded t-values) used by the string-based helpers."""
+        strokes_list = [self.cells(i) for i in range(len(self))]
+        t_values = np.round(self.t_values.astype(np.float64), 4)
+        t_values_list = [t_values[start:end].tolist() for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+        return strokes_list, t_values_list
+
+    def to_dict(self):
+        """JSON-ready flat arrays: xy is [x0, y0, x1, y1, ...] and stroke i covers points offsets[i]:offsets[i + 1]."""
+        return {
+            "ids": list(self.ids),
+            "offsets": self.offsets.tolist(),
+            "xy": self.xy.ravel().tolist(),
+            "t_values": np.round(self.t_values.astype(np.float64), 4).tolist(),
+        }
+
+    def to_bytes(self):
+        """
+        Packed little-endian form: b"SKS1", uint32 stroke and point counts, uint32 offsets, int16 xy, float32 t-values,
+        then the ids as UTF-8 joined by newlines. Every array starts 4-byte aligned so a client can view it in place.
+        """
+        header = STROKE_BYTES_MAGIC + np.array([len(self), len(self.xy)], dtype="<u4").tobytes()
+        return b"".join([header, self.offsets.astype("<u4").tobytes(), self.xy.astype("<i2").tobytes(),
+                         self.t_values.astype("<f4").tobytes(), "\n".join(i.replace("\n", " ") for i in self.ids).encode("utf-8")])
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != STROKE_BYTES_MAGIC:
+            raise ValueError("Not a packed stroke buffer")
+        num_strokes, num_points = np.frombuffer(data, dtype="<u4", count=2, offset=4).tolist()
+        pos = 12
+        offsets = np.frombuffer(data, dtype="<u4", count=num_strokes + 1, offset=pos)
+        pos += 4 * (num_strokes + 1)
+        xy = np.frombuffer(data, dtype="<i2", count=2 * num_points, offset=pos)
+        pos += 4 * num_points
+        t_values = np.frombuffer(data, dtype="<f4", count=num_points, offset=pos)
+        pos += 4 * num_points
+        ids = data[pos:].decode("utf-8").split("\n") if num_strokes else []
+        return cls(xy, t_values, offsets, ids)
+
+    def extend(self, other):
+        """Append the strokes of another buffer in place."""
+        self.xy = np.concatenate([self.xy, other.xy])
+        self.t_values = np.concatenate([self.t_values, other.t_values])
+        self.offsets = np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]])
+        self.ids = self.ids + list(other.ids)
+        return self
+
+    def select(self, start, stop=None):
+        """New buffer holding strokes [start:stop]."""
+        stop = len(self) if stop is None else stop
+        offsets = self.offsets[start:stop + 1]
+        return StrokeBuffer(self.xy[offsets[0]:offsets[-1]].copy(), self.t_values[offsets[0]:offsets[-1]].copy(),
+                            offsets - offsets[0], self.ids[start:stop])
+
+    def starts_with(self, other):
+        """True if the first len(other) strokes of this buffer are the strokes of other (same points and t-values)."""
+        n, num_points = len(other), len(other.xy)
+        return (n <= len(self) and np.array_equal(self.offsets[:n + 1], other.offsets)
+                and np.array_equal(self.xy[:num_points], other.xy) and np.array_equal(self.t_values[:num_points], other.t_values))
+
+    def pixels(self, cells_to_pixels_map):
+        """Pixel coordinates of every point, shape (N, 2). Vectorized for a CellGrid, per-cell lookup for a legacy dict."""
+        if isinstance(cells_to_pixels_map, CellGrid):
+            return cells_to_pixels_map.to_pixels(self.xy).astype(np.float64)
+        return np.array([cells_to_pixels_map[f"x{x}y{y}"] for x, y in self.xy.tolist()], dtype=np.float64).reshape(-1, 2)
+
+    def stroke_pixels(self, cells_to_pixels_map):
+        """Per-stroke (points, t_values) pairs in pixel space, ready for fit_strokes."""
+        pixels = self.pixels(cells_to_pixels_map)
+        t_values = self.t_values.astype(np.float64)
+        bounds = list(zip(self.offsets[:-1], self.offsets[1:]))
+        return [pixels[start:end] for start, end in bounds], [t_values[start:end] for start, end in bounds]
+
+
 # =================================
 # ===== SVG process related =======
 # =================================
@@ -136,39 +331,20 @@ def estimate_bezier_control_points_helper(sampled_points, t_values):
         return np.array([P0, P1])
 
     if n > len(t_values):
-        t_values = np.linespace(0,1,n)
-    
-    elif n == 3:
+        t_values = np.linspace(0, 1, n)
+
+    if n == 3:
         # Quadratic Bézier curve: we need to solve for three control points
-        A = np.zeros((n, 3))
-        for i in range(n):
-            t = t_values[i]
-            A[i, 0] = (1-t)**2
-            A[i, 1] = 2*(1-t)*t
-            A[i, 2] = t**2
-        
-        # Points (flattened)
         B = np.array(sampled_points).reshape(-1, 2)  # Assuming 2D points
-        
-        # Solve the system (least squares)
-        P = np.linalg.lstsq(A, B, rcond=None)[0]
-        return P
-
-    # Matrix A
-    A = np.zeros((n, 4))
-    for i in range(n):
-        t = t_values[i]
-        A[i, 0] = (1-t)**3
-        A[i, 1] = 3*(1-t)**2 * t
-        A[i, 2] = 3*(1-t) * t**2
-        A[i, 3] = t**3
-    
+
+        # Solve the system (least squares) with the cached pseudo-inverse
+        return bezier_fit_matrices(t_values[:n], degree=2)[1] @ B
+
     # Points (flattened)
     B = np.array(sampled_points).reshape(-1, 2)  # Assuming 2D points
-    
-    # Solve the system (least squares)
-    P = np.linalg.lstsq(A, B, rcond=None)[0]
-    return P
+
+    # Solve the system (least squares) with the cached pseudo-inverse
+    return bezier_fit_matrices(t_values[:n], degree=3)[1] @ B
 
     
 def estimate_bezier_control_points( sampled_points, t_values):
@@ -177,14 +353,10 @@ def estimate_bezier_control_points( sampled_points, t_values):
     P = estimate_bezier_control_points_helper(sampled_points, t_values)
 
     if len(sampled_points) > 4:
-        # Calculate the mean squared error between sampled points and the fitted Bézier curve.
-        errors = []
-        for i, t in enumerate(t_values):
-            B_t = bezier_point(P, t)
-            error = np.linalg.norm(B_t - sampled_points[i])
-            errors.append(error)
-        error = np.mean(errors)
-        
+        # Calculate the mean error between sampled points and the fitted Bézier curve.
+        A = bezier_fit_matrices(t_values, degree=3)[0]
+        error = np.mean(np.linalg.norm(A @ P - np.asarray(sampled_points, dtype=np.float64), axis=1))
+
         if error > 5 and len(sampled_points) >= 7:
             mid = len(sampled_points) // 2
             left_sampled_points = sampled_points[:mid+1]
@@ -193,12 +365,12 @@ def estimate_bezier_control_points( sampled_points, t_values):
             right_t_values = np.array(t_values[mid:])
 
             if len(left_sampled_points) == 3: # this applies in case we have 7 points
-                left_sampled_points.append(right_sampled_points[0])
-                left_t_values.append(right_t_values[0])
-                
+                left_sampled_points = list(left_sampled_points) + [right_sampled_points[0]]
+                left_t_values = np.append(left_t_values, right_t_values[0])
+
             # Normalize t_values for each segment
-            left_t_values = (left_t_values - left_t_values[0]) / (left_t_values[-1] - left_t_values[0])
-            right_t_values = (right_t_values - right_t_values[0]) / (right_t_values[-1] - right_t_values[0])
+            left_t_values = _renormalize_t_values(left_t_values)
+            right_t_values = _renormalize_t_values(right_t_values)
 
             # Recursively fit curves to each segment
             P_left = estimate_bezier_control_points_helper(left_sampled_points, left_t_values)
@@ -208,80 +380,897 @@ def estimate_bezier_control_points( sampled_points, t_values):
     return [P]
 
 
-def get_control_points(strokes_all, t_values_all, cells_to_pixels_map):
-    net_points = []      
-    for j in range(len(strokes_all)):
-        sampled_cells = strokes_all[j]
-        t_values = t_values_all[j]
-        sampled_points = []
-        for cell in sampled_cells:
-            y,x = cells_to_pixels_map[cell]
-            sampled_points.append([y,x])
-        points_lst = estimate_bezier_control_points(sampled_points, t_values)
-        net_points.append(points_lst)
+# ===== Batched fitting =====
+def bernstein_basis(t_values, degree=3):
+    """Bernstein basis for (a stack of) t-value vectors, shape (..., n) -> (..., n, degree + 1)."""
+    t = np.asarray(t_values, dtype=np.float64)[..., None]
+    k = np.arange(degree + 1)
+    coeffs = np.array([math.comb(degree, i) for i in k], dtype=np.float64)
+    return coeffs * t ** k * (1 - t) ** (degree - k)
+
+
+def _stroke_t_values(t_values, n):
+    # Same rule as estimate_bezier_control_points: fall back to uniform t when the counts disagree
+    if t_values is None or len(t_values) != n:
+        return np.linspace(0, 1, n)
+    return np.asarray(t_values, dtype=np.float64)
+
+
+def _renormalize_t_values(t_values):
+    # Map a piece of a stroke back to t in [0, 1]; a zero span (repeated t) becomes uniform
+    span = t_values[-1] - t_values[0]
+    if span == 0:
+        return np.linspace(0, 1, len(t_values))
+    return (t_values - t_values[0]) / span
+
+
+# Basis / pseudo-inverse cache: the LLM reuses a small vocabulary of t-value vectors,
+# so most fits reduce to one (degree + 1, n) @ (n, 2) multiply.
+BEZIER_CACHE_SIZE = 4096
+T_VALUES_DECIMALS = 4
+
+FIT_MODES = ("lstsq", "adaptive", "catmull_rom")
+FIT_TOLERANCE = 6.0  # pixels, half a cell of the default 12px grid
+
+
+@functools.lru_cache(maxsize=BEZIER_CACHE_SIZE)
+def _bezier_fit_matrices(t_key, degree):
+    A = bernstein_basis(np.array(t_key), degree)
+    A_pinv = np.linalg.pinv(A)
+    A.flags.writeable = False
+    A_pinv.flags.writeable = False
+    return A, A_pinv
+
+
+def bezier_fit_matrices(t_values, degree=3):
+    """Return the (read-only, cached) Bernstein matrix and its pseudo-inverse for a t-value vector."""
+    t_key = tuple(np.round(np.asarray(t_values, dtype=np.float64), T_VALUES_DECIMALS).tolist())
+    return _bezier_fit_matrices(t_key, degree)
+
+
+def bezier_cache_info():
+    """Hit / miss counters of the basis cache (functools CacheInfo: hits, misses, maxsize, currsize)."""
+    return _bezier_fit_matrices.cache_info()
+
+
+def bezier_cache_clear():
+    _bezier_fit_matrices.cache_clear()
+
+
+def fit_bezier_padded(strokes, degree=3):
+    """Fit one Bézier curve per (points, t_values) pair in a single stacked multiply. Returns (P, per-sample residuals)."""
+    N = max(len(points) for points, _ in strokes)
+    points_pad = np.zeros((len(strokes), N, 2))
+    A_pad = np.zeros((len(strokes), N, degree + 1))
+    A_pinv_pad = np.zeros((len(strokes), degree + 1, N))
+    for i, (points, t_values) in enumerate(strokes):
+        n = len(points)
+        A, A_pinv = bezier_fit_matrices(t_values, degree)
+        points_pad[i, :n] = points
+        A_pad[i, :n] = A
+        A_pinv_pad[i, :, :n] = A_pinv
+    # Padded samples have zero rows in A and zero columns in A_pinv, so they do not affect the fit and have zero residual
+    P = A_pinv_pad @ points_pad
+    return P, np.linalg.norm(A_pad @ P - points_pad, axis=-1)
+
+
+def _fit_short_stroke(points):
+    # Dots and straight lines need no solve
+    if len(points) == 1:
+        return np.array([points[0], points[0] + 0.0001])
+    return points
+
+
+def fit_stroke_adaptive(points, t_values, tolerance=FIT_TOLERANCE):
+    """
+    Fit a stroke with as many Bézier segments as needed for every sample to lie within tolerance pixels of the curve.
+    Segments are split recursively at the worst-fitting interior sample; residuals are computed in one vectorized pass.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n = len(points)
+    if n <= 2:
+        return [_fit_short_stroke(points)]
+
+    t_values = _stroke_t_values(t_values, n)
+    A, A_pinv = bezier_fit_matrices(t_values, degree=2 if n == 3 else 3)
+    P = A_pinv @ points
+    residuals = np.linalg.norm(A @ P - points, axis=1)
+    if n == 3 or residuals.max() <= tolerance:
+        return [P]
+
+    k = int(np.argmax(residuals[1:-1])) + 1
+    left = fit_stroke_adaptive(points[:k + 1], _renormalize_t_values(t_values[:k + 1]), tolerance)
+    right = fit_stroke_adaptive(points[k:], _renormalize_t_values(t_values[k:]), tolerance)
+    right[0] = np.vstack([left[-1][-1:], right[0][1:]])  # keep the segments connected
+    return left + right
+
+
+def catmull_rom_to_bezier(points, alpha=0.5):
+    """
+    Closed-form conversion of a stroke into cubic Bézier segments passing through every point (centripetal Catmull-Rom for alpha=0.5).
+    Consecutive duplicates are dropped; closed strokes wrap their tangents around, open strokes extrapolate one phantom point at each end.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) > 1:
+        points = points[np.r_[True, np.any(points[1:] != points[:-1], axis=1)]]
+    if len(points) <= 2:
+        return [_fit_short_stroke(points)]
+
+    if len(points) > 3 and np.array_equal(points[0], points[-1]):
+        padded = np.vstack([points[-2], points, points[1]])
+    else:
+        padded = np.vstack([2 * points[0] - points[1], points, 2 * points[-1] - points[-2]])
+    p0, p1, p2, p3 = padded[:-3], padded[1:-2], padded[2:-1], padded[3:]
+
+    # Knot intervals |p_i+1 - p_i|^alpha, with squared intervals (d^2) used in the tangent weights
+    d1 = np.linalg.norm(p1 - p0, axis=1, keepdims=True) ** alpha
+    d2 = np.linalg.norm(p2 - p1, axis=1, keepdims=True) ** alpha
+    d3 = np.linalg.norm(p3 - p2, axis=1, keepdims=True) ** alpha
+    d1[d1 == 0] = d2[d1 == 0]
+    d3[d3 == 0] = d2[d3 == 0]
+
+    b1 = (d1 ** 2 * p2 - d2 ** 2 * p0 + (2 * d1 ** 2 + 3 * d1 * d2 + d2 ** 2) * p1) / (3 * d1 * (d1 + d2))
+    b2 = (d3 ** 2 * p1 - d2 ** 2 * p3 + (2 * d3 ** 2 + 3 * d3 * d2 + d2 ** 2) * p2) / (3 * d3 * (d3 + d2))
+    return list(np.stack([p1, b1, b2, p2], axis=1))
+
+
+# ===== Stroke preprocessing =====
+COLLINEAR_TOLERANCE = 1.0  # pixels
+MIN_LINE_POINTS = 4  # with preprocess="runs", a straight run inside a curved piece needs this many points to become a line
+
+
+def _is_straight(piece, tolerance):
+    # every point within tolerance of the chord, moving forward along it
+    offsets = piece - piece[0]
+    chord = offsets[-1]
+    length = np.linalg.norm(chord)
+    if length == 0:
+        return False
+    distance = np.abs(offsets[:, 0] * chord[1] - offsets[:, 1] * chord[0]) / length
+    return bool(distance.max() <= tolerance and np.all(np.diff(offsets @ chord) > 0))
+
+
+def preprocess_strokes(points_all, t_values_all, collinear_tolerance=COLLINEAR_TOLERANCE, min_line_points=None):
+    """
+    preprocess_stroke for many strokes at once: the strokes are concatenated and every per-point test runs as one
+    vectorized pass over the whole sketch, so short strokes do not each pay numpy's per-call overhead.
+    Returns one list of (points, t_values, is_line) pieces per stroke.
+    """
+    points_all = [np.asarray(points, dtype=np.float64).reshape(-1, 2) for points in points_all]
+    t_values_all = [_stroke_t_values(t_values, len(points)) for points, t_values in zip(points_all, t_values_all)]
+    counts = np.array([len(points) for points in points_all], dtype=np.int64)
+    if counts.sum() < 2:
+        return [[(points, t_values, False)] for points, t_values in zip(points_all, t_values_all)]
+    points = np.concatenate(points_all)
+    t_values = np.concatenate(t_values_all)
+    stroke_of = np.repeat(np.arange(len(counts)), counts)
+
+    # collapse repeated points; a kept point that was followed by a copy of itself is a corner
+    repeated = np.all(points[1:] == points[:-1], axis=1) & (stroke_of[1:] == stroke_of[:-1])
+    keep = np.concatenate(([True], ~repeated))
+    is_bound = np.concatenate((repeated, [False]))[keep]
+    points, t_values, stroke_of = points[keep], t_values[keep], stroke_of[keep]
+    first = np.flatnonzero(np.concatenate(([True], stroke_of[1:] != stroke_of[:-1])))
+    last = np.concatenate((first[1:], [len(points)])) - 1
+    is_bound[first] = True
+    is_bound[last] = True
+    bounds = np.flatnonzero(is_bound)
+
+    # each segment against the chord of its corner-to-corner piece (the distance |cross| / |chord| is compared without
+    # dividing; an empty chord, i.e. a closed piece, fails the direction test)
+    segments = np.diff(points, axis=0)
+    segment_piece = np.cumsum(is_bound)[:-1] - 1
+    piece_starts = points[bounds[segment_piece]]
+    chords = points[bounds[segment_piece + 1]] - piece_starts
+    offsets = points[1:] - piece_starts
+    deviation = np.abs(offsets[:, 0] * chords[:, 1] - offsets[:, 1] * chords[:, 0])
+    on_chord = (deviation <= collinear_tolerance * np.hypot(chords[:, 0], chords[:, 1])) & (np.einsum("ij,ij->i", segments, chords) > 0)
+    # pieces between two strokes join one stroke's last point to the next one's first and are skipped below
+    straight_piece = np.logical_and.reduceat(on_chord, bounds[:-1])
+
+    bound_list = bounds.tolist()
+    lines = {(bound_list[k], bound_list[k + 1]) for k in np.flatnonzero(straight_piece).tolist()}
+    edges = np.zeros(0, dtype=np.int64)
+    if min_line_points:
+        # inside curved pieces: interior points on the chord of their neighbours, moving forward; bounds end the runs
+        across = points[2:] - points[:-2]
+        turn = np.abs(segments[:-1, 0] * across[:, 1] - segments[:-1, 1] * across[:, 0])
+        inner = np.zeros(len(points) + 1, dtype=np.int8)  # one zero of padding so every run closes
+        inner[1:-2] = ((turn <= collinear_tolerance * np.hypot(across[:, 0], across[:, 1]))
+                       & (np.einsum("ij,ij->i", segments[:-1], segments[1:]) > 0) & ~straight_piece[segment_piece[:-1]])
+        inner[bounds] = 0
+        edges = np.flatnonzero(np.diff(inner)) + 1
+    for run_start, run_stop in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        # the run's end points are its neighbours; a run that bends slowly keeps its part straight along the chord
+        start, end = run_start - 1, run_stop
+        while end - start + 1 >= min_line_points:
+            if _is_straight(points[start:end + 1], collinear_tolerance):
+                lines.add((start, end))
+                break
+            end -= 1
+
+    pieces_all = [[] for _ in points_all]
+    breaks = sorted(set(bound_list).union(*lines))
+    stroke_list = stroke_of.tolist()
+    for start, end in zip(breaks[:-1], breaks[1:]):
+        pieces = pieces_all[stroke_list[start]]
+        if stroke_list[end] != stroke_list[start]:
+            continue
+        if end - start == 1 or (start, end) in lines:
+            pieces.append((points[[start, end]], np.array([0.0, 1.0]), True))
+        else:
+            pieces.append((points[start:end + 1], _renormalize_t_values(t_values[start:end + 1]), False))
+    for i, pieces in enumerate(pieces_all):
+        if not pieces:  # fewer than two distinct points
+            stroke_points = points_all[i] if counts[i] < 2 else points_all[i][:1]
+            pieces.append((stroke_points, t_values_all[i][:len(stroke_points)], False))
+    return pieces_all
+
+
+def preprocess_stroke(points, t_values, collinear_tolerance=COLLINEAR_TOLERANCE, min_line_points=None):
+    """
+    Collapse consecutive duplicate points and split the stroke at repeated-point corners (the prompt marks corners by repeating a cell).
+    Returns a list of (points, t_values, is_line) pieces. A corner-to-corner piece whose points run monotonically along
+    its chord, within collinear_tolerance pixels, becomes a straight line holding only its two end points.
+    By default only whole corner-to-corner pieces qualify. With min_line_points, straight runs of at least that many
+    points inside a curved piece are split off as lines too and the curve is fitted around them; this suits sparse model
+    strokes, but turns the cell staircase of a smooth hand-drawn curve into a polygon.
+    """
+    return preprocess_strokes([points], [t_values], collinear_tolerance, min_line_points)[0]
+
+
+def _fit_preprocessed(points_all, t_values_all, fit_kwargs, min_line_points=None):
+    # Fit only the curved pieces (as one batch) and stitch lines and curves back together per stroke
+    layout, curve_points, curve_t_values = [], [], []
+    for pieces in preprocess_strokes(points_all, t_values_all, min_line_points=min_line_points):
+        stroke_layout = []
+        for piece, piece_t, is_line in pieces:
+            if is_line:
+                stroke_layout.append(piece)
+            else:
+                stroke_layout.append(len(curve_points))
+                curve_points.append(piece)
+                curve_t_values.append(piece_t)
+        layout.append(stroke_layout)
+
+    fitted = fit_strokes(curve_points, curve_t_values, **fit_kwargs)
+    net_points = []
+    for stroke_layout in layout:
+        segments = []
+        for item in stroke_layout:
+            if not isinstance(item, int):
+                segments.append(item)
+                continue
+            piece_segments = [np.array(segment) for segment in fitted[item]]
+            if len(curve_points[item]) > 1:
+                # pin the curve to its corners so the pieces meet exactly
+                piece_segments[0][0] = curve_points[item][0]
+                piece_segments[-1][-1] = curve_points[item][-1]
+            segments.extend(piece_segments)
+        net_points.append(segments)
     return net_points
 
 
-def get_control_points_single_stroke(strokes_all, t_values_all, cells_to_pixels_map):
-    sampled_points = []
-    for cell in strokes_all:
-        y,x = cells_to_pixels_map[cell]
-        sampled_points.append([y,x])
-    points_lst = estimate_bezier_control_points(sampled_points, t_values_all)
-    return points_lst
-
-
-def create_svg_path_data(control_points):
-    # Start the path with 'M' for the first point
-    # print("control_points", control_points[0])
-    path_data = 'M ' + np.array2string(np.array(control_points[0]), formatter={'float_kind':lambda x: "%.2f" % x}, separator=' ')[1:-1]    
-    # Add 'L' for each subsequent point
-
-    # check if point
-    if len(control_points) == 1:
-        path_data += ' '
-    # check if line
-    elif len(control_points) == 2:
-        path_data += ' L '
-    # check if quadratic
-    elif len(control_points) == 3:
-        path_data += ' Q '
-    # check if cubic
-    elif len(control_points) == 4:
-        path_data += ' C '
-    
-    # path_data += ' C '
-    for point in control_points[1:]:
-        # print("pt", point[0], point[1])
-        path_data += str(point[0]) + " " + str(point[1]) + " "
-    
-    # Return the complete 'd' attribute string
-    return path_data
+def fit_strokes(points_all, t_values_all, fit_mode="lstsq", tolerance=FIT_TOLERANCE, preprocess=False, max_error=5, min_split_points=7):
+    """
+    Fit Bézier control points for many strokes at once.
+    Strokes are grouped by point count (quadratic for 3 points, cubic above) and each group is padded and solved as one stacked batch.
+    fit_mode "lstsq" follows estimate_bezier_control_points: long strokes whose mean error is above max_error are split once at the middle.
+    fit_mode "adaptive" refits every stroke that has a sample further than tolerance pixels from its curve with fit_stroke_adaptive.
+    fit_mode "catmull_rom" skips least squares and interpolates every sample with catmull_rom_to_bezier (t-values are not used).
+    With preprocess (True or "corners"), strokes first go through preprocess_strokes: straight corner-to-corner pieces
+    become lines and only curved pieces are fitted; preprocess="runs" also splits straight runs out of curved pieces.
+    """
+    if fit_mode not in FIT_MODES:
+        raise ValueError(f"Unknown fit_mode '{fit_mode}', expected one of {FIT_MODES}")
+    if preprocess:
+        fit_kwargs = dict(fit_mode=fit_mode, tolerance=tolerance, max_error=max_error, min_split_points=min_split_points)
+        return _fit_preprocessed(points_all, t_values_all, fit_kwargs, MIN_LINE_POINTS if preprocess == "runs" else None)
+    if fit_mode == "catmull_rom":
+        return [catmull_rom_to_bezier(points) for points in points_all]
+
+    net_points = [None] * len(points_all)
+    groups = {2: [], 3: []}
+    for idx, (points, t_values) in enumerate(zip(points_all, t_values_all)):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        n = len(points)
+        if n <= 2:
+            net_points[idx] = [_fit_short_stroke(points)]
+        else:
+            groups[2 if n == 3 else 3].append((idx, points, _stroke_t_values(t_values, n)))
+
+    to_split = []
+    for degree, members in groups.items():
+        if not members:
+            continue
+        P, residuals = fit_bezier_padded([(points, t_values) for _, points, t_values in members], degree)
+        for (idx, points, t_values), P_i, residuals_i in zip(members, P, residuals):
+            n = len(points)
+            if fit_mode == "adaptive" and n > 3 and residuals_i.max() > tolerance:
+                net_points[idx] = fit_stroke_adaptive(points, t_values, tolerance)
+            elif fit_mode == "lstsq" and n >= min_split_points and residuals_i.sum() / n > max_error:
+                to_split.append((idx, points, t_values))
+            else:
+                net_points[idx] = [P_i]
+
+    if to_split:
+        lefts, rights = [], []
+        for _, points, t_values in to_split:
+            mid = len(points) // 2
+            lefts.append((points[:mid + 1], _renormalize_t_values(t_values[:mid + 1])))
+            rights.append((points[mid:], _renormalize_t_values(t_values[mid:])))
+        P_left, _ = fit_bezier_padded(lefts)
+        P_right, _ = fit_bezier_padded(rights)
+        P_right[:, 0] = P_left[:, -1]  # keep the two halves connected
+        for (idx, _, _), P_l, P_r in zip(to_split, P_left, P_right):
+            net_points[idx] = [P_l, P_r]
+    return net_points
+
+
+def cells_to_points(sampled_cells, cells_to_pixels_map):
+    if isinstance(cells_to_pixels_map, CellGrid):
+        xy = [(int(x), int(y)) for x, y in CELL_PATTERN.findall(" ".join(sampled_cells))]
+        return cells_to_pixels_map.to_pixels(np.array(xy, dtype=np.int64).reshape(-1, 2)).astype(np.float64)
+    return np.array([cells_to_pixels_map[cell] for cell in sampled_cells], dtype=np.float64).reshape(-1, 2)
+
+
+def _sketch_points(strokes_all, t_values_all, cells_to_pixels_map):
+    # Per-stroke pixel points and t-values from either a StrokeBuffer or the list-of-lists format
+    if isinstance(strokes_all, StrokeBuffer):
+        return strokes_all.stroke_pixels(cells_to_pixels_map)
+    return [cells_to_points(cells, cells_to_pixels_map) for cells in strokes_all], list(t_values_all)
+
+
+def get_control_points_batch(sketches_strokes, sketches_t_values, cells_to_pixels_map, fit_mode="lstsq", tolerance=FIT_TOLERANCE, preprocess=False):
+    """
+    Fit the strokes of many sketches in one batch. Returns one get_control_points result per sketch.
+    Each sketch is either a StrokeBuffer (its t-values entry is ignored) or a list of cell-string strokes.
+    """
+    points_all, t_values_all, counts = [], [], []
+    for strokes_all, t_values_all_sketch in zip(sketches_strokes, sketches_t_values):
+        points, t_values = _sketch_points(strokes_all, t_values_all_sketch, cells_to_pixels_map)
+        points_all.extend(points)
+        t_values_all.extend(t_values)
+        counts.append(len(points))
+
+    net_points = fit_strokes(points_all, t_values_all, fit_mode=fit_mode, tolerance=tolerance, preprocess=preprocess)
+    bounds = np.cumsum([0] + counts)
+    return [net_points[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def get_control_points(strokes_all, t_values_all, cells_to_pixels_map, fit_mode="lstsq", tolerance=FIT_TOLERANCE, preprocess=False):
+    return get_control_points_batch([strokes_all], [t_values_all], cells_to_pixels_map, fit_mode, tolerance, preprocess)[0]
+
+
+def get_control_points_single_stroke(strokes_all, t_values_all, cells_to_pixels_map, fit_mode="lstsq", tolerance=FIT_TOLERANCE, preprocess=False):
+    if isinstance(strokes_all, StrokeBuffer):
+        return get_control_points(strokes_all, None, cells_to_pixels_map, fit_mode, tolerance, preprocess)[0]
+    return get_control_points([strokes_all], [t_values_all], cells_to_pixels_map, fit_mode, tolerance, preprocess)[0]
+
+
+# ===== SVG serialization =====
+SVG_PRECISION = 2
+SVG_PATH_COMMANDS = {1: "", 2: " L", 3: " Q", 4: " C"}
+# "default" writes one styled <g> per stroke with absolute commands; "compact" quantizes coordinates, uses relative
+# commands, merges the segments of a stroke into a single <path> and sets the shared style once on the <svg> root
+SVG_PROFILES = ("default", "compact")
+SVG_PROFILE_PRECISION = {"default": SVG_PRECISION, "compact": 1}
+SVG_COMPACT_COMMANDS = {1: "", 2: "l", 3: "q", 4: "c"}
+SVG_STROKE_STYLE = 'stroke="{stroke_color}" stroke-width="{stroke_width}" fill="none" stroke-linecap="round" stroke-linejoin="round"'
+
+
+def _svg_precision(profile, precision):
+    if profile not in SVG_PROFILES:
+        raise ValueError(f"Unknown SVG profile '{profile}', expected one of {SVG_PROFILES}")
+    return SVG_PROFILE_PRECISION[profile] if precision is None else precision
+
+
+@functools.lru_cache(maxsize=None)
+def _path_data_template(num_points, precision):
+    # printf template of a 'd' attribute: 'M x y' followed by 'L' (line), 'Q' (quadratic) or 'C' (cubic) and the remaining points
+    coord = f" %.{precision}f %.{precision}f"
+    return "M" + coord + SVG_PATH_COMMANDS.get(num_points, "") + coord * (num_points - 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _path_template(num_points, precision):
+    return '<path d="' + _path_data_template(num_points, precision) + '"/>\n'
+
+
+@functools.lru_cache(maxsize=65536)
+def _compact_number(value, precision):
+    # value is an integer in units of 10**-precision: drop trailing zeros and the leading zero ("0.50" -> ".5")
+    if precision <= 0:
+        return str(value * 10 ** -precision)
+    text = f"{value / 10 ** precision:.{precision}f}".rstrip("0").rstrip(".")
+    if text.startswith("0."):
+        return text[1:]
+    if text.startswith("-0."):
+        return "-" + text[2:]
+    return "0" if text == "-0" else text
+
+
+def _compact_points(quantized, precision):
+    return " ".join(_compact_number(v, precision) for v in quantized.ravel().tolist())
+
+
+def _compact_path_data(segments, precision):
+    """
+    'd' attribute of one stroke: the segments are quantized to multiples of 10**-precision, the first point is absolute
+    and everything after it is relative. A segment starting where the previous one ended continues without a moveto.
+    """
+    scale = 10.0 ** precision
+    parts, current = [], None
+    for segment in segments:
+        # quantize absolute coordinates so the relative offsets never accumulate rounding drift
+        points = np.rint(segment * scale).astype(np.int64)
+        start = points[0]
+        if current is None:
+            parts.append("M" + _compact_points(start, precision))
+        elif (start != current).any():
+            parts.append("m" + _compact_points(start - current, precision))
+        if len(points) > 1:
+            parts.append(SVG_COMPACT_COMMANDS.get(len(points), "") + _compact_points(points[1:] - start, precision))
+        current = points[-1]
+    return "".join(parts)
 
 
-def format_svg(all_control_points, dim, stroke_width):
+def create_svg_path_data(control_points, precision=SVG_PRECISION):
+    control_points = np.asarray(control_points, dtype=np.float64).reshape(-1, 2)
+    return _path_data_template(len(control_points), precision) % tuple(control_points.ravel().tolist())
+
+
+def _serialize_groups(all_control_points, stroke_ids, stroke_width, stroke_color, precision, profile="default"):
+    if profile == "compact":
+        # the root <svg> carries the black stroke style (see format_svg_header), groups only override the color
+        color = "" if stroke_color == "black" else f' stroke="{stroke_color}"'
+        return [f'<g id="s{stroke_id}"{color}><path d="' +
+                _compact_path_data([np.asarray(segment, dtype=np.float64).reshape(-1, 2) for segment in group], precision) +
+                '"/></g>\n'
+                for stroke_id, group in zip(stroke_ids, all_control_points)]
+
+    # Format every coordinate of every stroke with one tolist() and one printf template per path
+    segments = [np.asarray(segment, dtype=np.float64).reshape(-1, 2) for group in all_control_points for segment in group]
+    values = np.concatenate(segments).ravel().tolist() if segments else []
+    group_open = '<g id="s%d" ' + SVG_STROKE_STYLE.format(stroke_color=stroke_color, stroke_width=stroke_width) + '>\n'
+
+    svg_groups, pos, k = [], 0, 0
+    for stroke_id, group in zip(stroke_ids, all_control_points):
+        parts = [group_open % stroke_id]
+        for _ in range(len(group)):
+            num_values = 2 * len(segments[k])
+            parts.append(_path_template(len(segments[k]), precision) % tuple(values[pos:pos + num_values]))
+            pos += num_values
+            k += 1
+        parts.append("</g>\n")
+        svg_groups.append("".join(parts))
+    return svg_groups
+
+
+def format_svg_groups(all_control_points, stroke_width, first_id=1, stroke_color="black", precision=None, profile="default"):
+    """Serialize the <g id="sN"> group of every stroke in one pass, numbering strokes from first_id."""
+    precision = _svg_precision(profile, precision)
+    stroke_ids = range(first_id, first_id + len(all_control_points))
+    return _serialize_groups(all_control_points, stroke_ids, stroke_width, stroke_color, precision, profile)
+
+
+def format_svg_header(dim, stroke_width=None, profile="default"):
+    """Opening <svg> tag. The compact profile sets the stroke style shared by all groups here."""
+    _svg_precision(profile, None)
     svg_width, svg_height = dim
-    sketch_text_svg = f"""<svg width="{svg_width}" height="{svg_height}" xmlns="http://www.w3.org/2000/svg">\n"""        
-    for i, path in enumerate(all_control_points):
-        gropu_text = f"""<g id="s{i + 1}" stroke="black" stroke-width="{stroke_width}" fill="none" stroke-linecap="round">\n"""
-        for sub_path_cp in path:  #sometimes 1 or 2 
-            path_data = create_svg_path_data(sub_path_cp)
-            gropu_text += f"""<path d="{path_data}"/>\n"""
-        gropu_text += "</g>\n"
-        sketch_text_svg += gropu_text
-    sketch_text_svg += "</svg>"
-    return sketch_text_svg
-
-
-def format_svg_single_stroke(group, dim, stroke_width, stroke_counter, stroke_color="black"):
-    sketch_text_svg = ""      
-    gropu_text = f"""<g id="s{stroke_counter}" stroke="{stroke_color}" stroke-width="{stroke_width}" fill="none" stroke-linecap="round">\n"""
-    for sub_path_cp in group: 
-        path_data = create_svg_path_data(sub_path_cp)
-        gropu_text += f"""<path d="{path_data}"/>\n"""
-    gropu_text += "</g>\n"
-    sketch_text_svg += gropu_text
-    return sketch_text_svg
+    if profile == "compact":
+        style = SVG_STROKE_STYLE.format(stroke_color="black", stroke_width=stroke_width)
+        return f"""<svg width="{svg_width}" height="{svg_height}" xmlns="http://www.w3.org/2000/svg" {style}>\n"""
+    return f"""<svg width="{svg_width}" height="{svg_height}" xmlns="http://www.w3.org/2000/svg">\n"""
+
+
+def format_svg_document(svg_groups, dim, stroke_width=None, profile="default"):
+    """Wrap already-serialized stroke groups into an SVG document."""
+    return format_svg_header(dim, stroke_width, profile) + "".join(svg_groups) + "</svg>"
+
+
+def format_svg(all_control_points, dim, stroke_width, precision=None, profile="default"):
+    svg_groups = format_svg_groups(all_control_points, stroke_width, precision=precision, profile=profile)
+    return format_svg_document(svg_groups, dim, stroke_width, profile)
+
+
+def format_svg_batch(sketches_control_points, dim, stroke_width, precision=None, profile="default"):
+    """Serialize many sketches (e.g. a get_control_points_batch result) in one pass. Returns one SVG document per sketch."""
+    precision = _svg_precision(profile, precision)
+    all_control_points = [group for sketch in sketches_control_points for group in sketch]
+    stroke_ids = [i + 1 for sketch in sketches_control_points for i in range(len(sketch))]
+    svg_groups = _serialize_groups(all_control_points, stroke_ids, stroke_width, "black", precision, profile)
+    bounds = np.cumsum([0] + [len(sketch) for sketch in sketches_control_points])
+    return [format_svg_document(svg_groups[start:end], dim, stroke_width, profile) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def format_svg_single_stroke(group, dim, stroke_width, stroke_counter, stroke_color="black", precision=None, profile="default"):
+    return format_svg_groups([group], stroke_width, first_id=stroke_counter, stroke_color=stroke_color, precision=precision, profile=profile)[0]
+
+
+def strokes_to_svg(strokes, cells_to_pixels_map, dim, stroke_width, fit_mode="lstsq", tolerance=FIT_TOLERANCE, preprocess=False, precision=None, profile="default"):
+    """Fit a StrokeBuffer and emit the SVG document."""
+    all_control_points = get_control_points(strokes, None, cells_to_pixels_map, fit_mode=fit_mode, tolerance=tolerance, preprocess=preprocess)
+    return format_svg(all_control_points, dim, stroke_width, precision=precision, profile=profile)
+
+
+# ===== Rasterization =====
+RASTER_SUPERSAMPLE = 3  # 10 coverage levels per edge pixel; 4 costs ~1.6x the time for a barely visible difference
+RASTER_TOLERANCE = 0.2  # max distance (px) between a curve and its flattened polyline
+
+
+def flatten_segment(control_points, tolerance=RASTER_TOLERANCE):
+    """Sample one line / quadratic / cubic segment (2-4 control points) into a polyline within `tolerance` pixels of the curve."""
+    control_points = np.asarray(control_points, dtype=np.float64).reshape(-1, 2)
+    degree = len(control_points) - 1
+    if degree <= 1:
+        return control_points
+    # a chord of parameter length 1/n deviates from the curve by at most max|B''| / (8 n^2)
+    max_second_diff = np.linalg.norm(np.diff(control_points, n=2, axis=0), axis=1).max()
+    num_chords = int(min(max(math.ceil(math.sqrt(degree * (degree - 1) * max_second_diff / (8 * tolerance))), 1), 256))
+    return bernstein_basis(np.linspace(0, 1, num_chords + 1), degree) @ control_points
+
+
+def strokes_coverage(strokes_control_points, stroke_width, size, supersample=RASTER_SUPERSAMPLE):
+    """
+    Anti-aliased coverage of the union of some strokes (each a list of segments) drawn with round caps and joins.
+    Only their bounding box is rasterized: returns (x0, y0, mask) where mask is an "L" image covering pixels
+    [x0, x0 + w) x [y0, y0 + h) of the canvas, or None if nothing falls inside it.
+    """
+    polylines = [flatten_segment(segment) for group in strokes_control_points for segment in group]
+    if not polylines:
+        return None
+    points = np.concatenate(polylines)
+    radius = stroke_width / 2
+    x0, y0 = np.floor(points.min(axis=0) - radius - 1).astype(int)
+    x1, y1 = np.ceil(points.max(axis=0) + radius + 1).astype(int)
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, size[0]), min(y1, size[1])
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    mask = Image.new("L", ((x1 - x0) * supersample, (y1 - y0) * supersample), 0)
+    draw = ImageDraw.Draw(mask)
+    width = max(int(round(stroke_width * supersample)), 1)
+    r = (width - 1) / 2  # ellipse boxes are inclusive
+    for polyline in polylines:
+        # SVG coordinates are continuous while PIL addresses pixel centers
+        xy = (polyline - (x0, y0)) * supersample - 0.5
+        if len(xy) > 1:
+            draw.line(xy.ravel().tolist(), fill=255, width=width)
+        # round caps and joins (ImageDraw's own joint="curve" is much slower). Every vertex needs one: PIL's wide
+        # line segments leave pinholes where they meet even at shallow turns
+        for x, y in xy.tolist():
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=255)
+    # box filter down to the canvas resolution gives the anti-aliasing
+    return x0, y0, mask.reduce(supersample)
+
+
+def paint_coverage(image, x0, y0, mask, color):
+    """Paint `color` through a coverage mask onto an RGB or RGBA image at (x0, y0), in place (blending is done by PIL)."""
+    rgb = ImageColor.getrgb(color)[:3] if isinstance(color, str) else tuple(color)[:3]
+    if image.mode == "RGB":
+        image.paste(rgb, (x0, y0, x0 + mask.width, y0 + mask.height), mask)
+        return
+    layer = Image.new("RGBA", mask.size, rgb + (255,))
+    layer.putalpha(mask)
+    image.alpha_composite(layer, (x0, y0))
+
+
+def _raster_image(size, background):
+    if background is None:
+        return Image.new("RGBA", size, (0, 0, 0, 0))
+    if isinstance(background, Image.Image):
+        return background.convert("RGB")
+    return Image.new("RGB", size, background)
+
+
+def render_strokes(all_control_points, size, stroke_width, stroke_colors="black", background="white", supersample=RASTER_SUPERSAMPLE):
+    """
+    Rasterize fitted strokes directly from their control points, without going through an SVG document.
+    background is a color name (the result is RGB), None (a transparent RGBA stroke layer), or an image such as the
+    grid canvas the LLM sees, which is copied and drawn on at its own size.
+    stroke_colors is a single color or one color per stroke.
+    """
+    if isinstance(background, Image.Image):
+        size = background.size
+    if isinstance(stroke_colors, str):
+        stroke_colors = [stroke_colors] * len(all_control_points)
+    image = _raster_image(size, background)
+    # consecutive strokes of the same color are covered together, so a one-color sketch is a single mask
+    start = 0
+    for end in range(1, len(all_control_points) + 1):
+        if end < len(all_control_points) and stroke_colors[end] == stroke_colors[start]:
+            continue
+        coverage = strokes_coverage(all_control_points[start:end], stroke_width, size, supersample)
+        if coverage is not None:
+            paint_coverage(image, *coverage, stroke_colors[start])
+        start = end
+    return image
+
+
+class RasterSurface:
+    """
+    A live raster image that strokes are composited onto one at a time, so drawing the n-th stroke costs the same as the first:
+    only the new stroke's bounding box is rasterized and blended. Each stroke is composited on its own, so
+    where strokes of one color overlap the result is darker than render_strokes, which draws them as a single mask.
+    """
+    def __init__(self, size, stroke_width, background="white", supersample=RASTER_SUPERSAMPLE):
+        self.size = tuple(size)
+        self.stroke_width = stroke_width
+        self.background = background
+        self.supersample = supersample
+        self.clear()
+
+    def clear(self):
+        self.image = _raster_image(self.size, self.background)
+
+    def add(self, group, stroke_color="black"):
+        """Composite one stroke (a list of segments). Returns the rectangle it changed, or None."""
+        coverage = strokes_coverage([group], self.stroke_width, self.size, self.supersample)
+        if coverage is None:
+            return None
+        x0, y0, mask = coverage
+        paint_coverage(self.image, x0, y0, mask, stroke_color)
+        return x0, y0, x0 + mask.width, y0 + mask.height
+
+    def save(self, path, **save_kwargs):
+        self.image.save(path, **save_kwargs)
+
+
+def fit_and_format_strokes(strokes, cells_to_pixels_map, stroke_width, first_id=1, fit_args=None, svg_args=None):
+    """Fit a StrokeBuffer and serialize its groups. A module-level function so it can run in a worker process."""
+    control_points = get_control_points(strokes, None, cells_to_pixels_map, **(fit_args or {}))
+    return control_points, format_svg_groups(control_points, stroke_width, first_id=first_id, **(svg_args or {}))
+
+
+class FittedSketch:
+    """
+    Accumulated strokes of a sketch together with their fitted control points and serialized SVG groups.
+    Adding strokes fits and serializes only the new ones, so a long chain of edits costs O(new strokes) per step.
+    """
+    def __init__(self, cells_to_pixels_map, dim, stroke_width, fit_args=None, svg_args=None):
+        self.cells_to_pixels_map = cells_to_pixels_map
+        self.dim = dim
+        self.stroke_width = stroke_width
+        self.fit_args = fit_args or {}
+        self.svg_args = svg_args or {}  # "profile" / "precision" of format_svg_groups
+        self.strokes = StrokeBuffer()
+        self.control_points = []
+        self.svg_groups = []
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def copy(self):
+        """Copy that can be extended without touching this sketch; the fitted strokes are shared, not re-fitted."""
+        sketch = FittedSketch(self.cells_to_pixels_map, self.dim, self.stroke_width, self.fit_args, self.svg_args)
+        sketch.strokes = self.strokes.select(0)
+        sketch.control_points = list(self.control_points)
+        sketch.svg_groups = list(self.svg_groups)
+        return sketch
+
+    def add(self, strokes, pool=None):
+        """
+        Fit and serialize a StrokeBuffer of new strokes and append it. Returns the new control points.
+        The fitting runs on `pool` (a WorkerPool) when given and the batch is large enough (see fit_runner).
+        """
+        run = fit_runner(pool, len(strokes))
+        new_control_points, new_svg_groups = run(fit_and_format_strokes, strokes, self.cells_to_pixels_map, self.stroke_width,
+                                                 len(self.strokes) + 1, self.fit_args, self.svg_args)
+        self.svg_groups.extend(new_svg_groups)
+        self.control_points.extend(new_control_points)
+        self.strokes.extend(strokes)
+        return new_control_points
+
+    def svg(self):
+        return format_svg_document(self.svg_groups, self.dim, self.stroke_width, self.svg_args.get("profile", "default"))
+
+    def render(self, background="white", width=None, pool=None):
+        """
+        Rasterize the accumulated strokes natively (see render_strokes), on `pool` when given.
+        width re-renders the vector strokes at another resolution (the height follows the aspect ratio).
+        """
+        run = pool.run if pool is not None else _run_inline
+        if width is None or width == self.dim[0]:
+            return run(render_strokes, self.control_points, self.dim, self.stroke_width, background=background)
+        scale = width / self.dim[0]
+        size = (int(width), int(round(self.dim[1] * scale)))
+        control_points = [[np.asarray(segment, dtype=np.float64) * scale for segment in group] for group in self.control_points]
+        return run(render_strokes, control_points, size, self.stroke_width * scale, background=background)
+
+
+def format_stroke_data(strokes, stroke_format="json", concept=None):
+    """stroke_data payload for the API in a compact STROKE_DATA_FORMATS format ("xml" is built by SketchApp)."""
+    if stroke_format == "json":
+        return {"concept": concept, **strokes.to_dict()}
+    if stroke_format == "binary":
+        return base64.b64encode(strokes.to_bytes()).decode("ascii")
+    raise ValueError(f"Unknown stroke data format '{stroke_format}', expected 'json' or 'binary'")
+
+
+# One pattern walks a whole <strokes> block: an opening <sN> starts a stroke, and each <points>, <t_values> or <id>
+# field is attached to the stroke opened last. Closing </sN> tags need no handling.
+STROKE_TOKEN_PATTERN = re.compile(r"<(s\d+)>|<(points|t_values|id)>(.*?)</\2>", re.S)
+
+
+def parse_stroke_block(text, res):
+    """
+    Single-pass parse of the strokes in text (a <strokes> block or a lone <sN> element) into a StrokeBuffer.
+    Grid coordinates are clamped to [1, res]; strokes whose t-values do not match their point count get uniform t.
+    """
+    cells, t_values, counts, ids = [], [], [0], []
+    fields = None
+
+    def close_stroke():
+        stroke_cells = CELL_PATTERN.findall(fields.get("points") or "")
+        stroke_t = NUMBER_PATTERN.findall(fields.get("t_values") or "")
+        n = len(stroke_cells)
+        cells.extend(stroke_cells)
+        t_values.extend(stroke_t if len(stroke_t) == n else np.linspace(0, 1, n).tolist())
+        counts.append(counts[-1] + n)
+        stroke_id = (fields.get("id") or "").strip()
+        ids.append(stroke_id or fields["tag"])
+
+    for match in STROKE_TOKEN_PATTERN.finditer(text):
+        tag, field, value = match.groups()
+        if tag is not None:
+            if fields is not None:
+                close_stroke()
+            fields = {"tag": tag}
+        elif fields is not None:
+            fields.setdefault(field, value)
+    if fields is not None:
+        close_stroke()
+
+    # cells and t-values are still the matched strings here; numpy converts (and clamps) them in one go each
+    xy = np.minimum(np.maximum(np.array(cells, dtype=np.int64).reshape(-1, 2), 1), res)
+    return StrokeBuffer(xy, np.array(t_values, dtype=np.float64), counts, ids)
+
+
+def _find_tagged_block(llm_output, start_marker, end_marker):
+    start_index = llm_output.find(start_marker)
+    if start_index == -1:
+        return None
+    end_index = llm_output.find(end_marker, start_index)
+    if end_index == -1:
+        return None
+    return llm_output[start_index:end_index + len(end_marker)].strip()
+
+
+def parse_strokes(llm_output, res):
+    """Like parse_xml_string, but returns the first <strokes> block as a StrokeBuffer (with stroke ids) instead of literal strings."""
+    strokes_str = _find_tagged_block(llm_output, "<strokes>", "</strokes>")
+    if strokes_str is None:
+        return None
+    return parse_stroke_block(strokes_str, res)
+
+
+def parse_stroke(llm_output, res, stroke_counter):
+    """Like parse_xml_string_single_stroke, but returns stroke <s{stroke_counter}> as a one-stroke StrokeBuffer."""
+    stroke_str = _find_tagged_block(llm_output, f"<s{stroke_counter}>", f"</s{stroke_counter}>")
+    if stroke_str is None:
+        return None
+    return parse_stroke_block(stroke_str, res)
+
+
+class StrokeStreamParser:
+    """
+    Incremental stroke parser for streamed LLM output. feed() takes text chunks in any split (including mid-tag) and
+    returns (tag, stroke) for every <sN> element whose closing </sN> arrived with it, stroke being a one-stroke StrokeBuffer.
+    Text is scanned once: only the currently open stroke (or a possibly cut-off tag) is kept between chunks.
+    """
+    OPEN_PATTERN = re.compile(r"<(s\d+)>|</strokes>")
+
+    def __init__(self, res):
+        self.res = res
+        self.strokes = StrokeBuffer()  # every stroke closed so far
+        self.finished = False  # </strokes> seen
+        self._buffer = ""
+        self._tag = None  # open stroke
+        self._scan = 0  # where the search for the open stroke's closing tag resumes
+
+    def feed(self, chunk):
+        """Consume chunk and return the [(tag, stroke), ...] it completed (often empty)."""
+        self._buffer += chunk
+        closed = []
+        while not self.finished:
+            if self._tag is None:
+                match = self.OPEN_PATTERN.search(self._buffer)
+                if match is None:
+                    # keep a trailing '<...' that may be the start of a tag cut by the chunk boundary
+                    cut = self._buffer.rfind("<")
+                    self._buffer = self._buffer[cut:] if cut != -1 and ">" not in self._buffer[cut:] else ""
+                    break
+                if match.group(1) is None:
+                    self.finished = True
+                    self._buffer = ""
+                    break
+                self._tag = match.group(1)
+                self._buffer = self._buffer[match.start():]
+                self._scan = match.end() - match.start()
+
+            end_marker = f"</{self._tag}>"
+            end = self._buffer.find(end_marker, self._scan)
+            if end == -1:
+                self._scan = max(self._scan, len(self._buffer) - len(end_marker) + 1)
+                break
+            end += len(end_marker)
+            tag, stroke_text = self._tag, self._buffer[:end]
+            self._buffer = self._buffer[end:]
+            self._tag = None
+            stroke = parse_stroke_block(stroke_text, self.res)
+            self.strokes.extend(stroke)
+            closed.append((tag, stroke))
+        return closed
+
+
+STROKE_FIELD_PATTERN = re.compile(r"<(points|t_values|id)>(.*?)</\1>", re.S)
+STROKE_OPEN_PATTERN = re.compile(r"<(s\d+)>")
+
+
+class SalvagedStrokes:
+    """
+    Result of salvage_strokes: the well-formed strokes, the (tag, reason) of every stroke that was dropped, and
+    whether the output reached </strokes>. When it did not, resume_text is the output up to the last stroke kept,
+    ready to be sent back as an assistant prefill so the model writes only the missing tail; it is None when
+    <strokes> never opened, as there is then no block to continue.
+    """
+    __slots__ = ("strokes", "tags", "dropped", "complete", "resume_text")
+
+    def __init__(self, strokes, tags, dropped, complete, resume_text):
+        self.strokes = strokes
+        self.tags = tags
+        self.dropped = dropped
+        self.complete = complete
+        self.resume_text = resume_text
+
+
+def _stroke_defect(fields):
+    if "points" not in fields:
+        return "missing <points>"
+    if not CELL_PATTERN.search(fields["points"]):
+        return "no cells in <points>"
+    if "t_values" not in fields:
+        return "missing <t_values>"
+    return None
+
+
+def salvage_strokes(llm_output, res):
+    """
+    Tolerant counterpart of parse_strokes for truncated or malformed output. A stroke is kept if it has a closed
+    <points> with at least one cell and a closed <t_values>, even when its </sN> is missing, except for the last
+    stroke of an output cut off before </strokes>, which is always dropped as truncated.
+    """
+    start = llm_output.find("<strokes>")
+    body_start = 0 if start == -1 else start + len("<strokes>")
+    end = -1 if start == -1 else llm_output.find("</strokes>", body_start)
+    complete = end != -1
+    body_end = end if complete else len(llm_output)
+
+    opens = list(STROKE_OPEN_PATTERN.finditer(llm_output, body_start, body_end))
+    kept, tags, dropped = [], [], []
+    resume = body_start
+    for k, match in enumerate(opens):
+        tag = match.group(1)
+        region_end = opens[k + 1].start() if k + 1 < len(opens) else body_end
+        close = llm_output.find(f"</{tag}>", match.end(), region_end)
+        if close == -1 and k + 1 == len(opens) and not complete:
+            dropped.append((tag, "truncated"))
+            continue
+        stroke_end = region_end if close == -1 else close + len(tag) + 3
+        fields = {}
+        for field in STROKE_FIELD_PATTERN.finditer(llm_output, match.end(), stroke_end):
+            fields.setdefault(field.group(1), field.group(2))
+        defect = _stroke_defect(fields)
+        if defect is not None:
+            dropped.append((tag, defect))
+            continue
+        kept.append(llm_output[match.start():stroke_end])
+        tags.append(tag)
+        resume = stroke_end
+
+    strokes = parse_stroke_block("\n".join(kept), res)
+    return SalvagedStrokes(strokes, tags, dropped, complete, None if complete or start == -1 else llm_output[:resume])
 
 
 # Note that this parse only the *first* part in the text in which you have the <strokes> </strokes> tags.
@@ -370,23 +1359,431 @@ def parse_xml_string_single_stroke(llm_output, res, stroke_counter):
 
 
 # =====================================
-# ===== Collaborative Sketching =======
+# ===== Image output ==================
 # =====================================
-def get_cur_stroke_text(stroke_counter, llm_output):
-    start_marker = f"<s{stroke_counter}>"
-    end_marker = f"</s{stroke_counter}>"
+PNG_ENCODINGS = ("rgb", "palette", "1bit")
+PNG_ENCODING = "palette"
+PNG_COMPRESS_LEVEL = 6
+PNG_PALETTE_SIZE = 16  # 4-bit PNG
+PNG_MAX_INKS = 4
+PNG_MAX_RESIDUAL = 24.0  # mean distance (0-255 RGB) above which an image is not treated as line art
 
-    # Find the start and end indices of the JSON string
-    start_index = llm_output.find(start_marker)
-    if start_index != -1:
-        # start_index += len(strokes_start_marker)  # Move past the marker
-        end_index = llm_output.find(end_marker, start_index)
-    else:
-        return ""  # XML markers not found
 
-    if end_index == -1:
-        return ""  # End marker not found
+PNG_INK_CANDIDATES = 64
+# Inks of the sketches drawn here (black; green / pink strokes in collab mode): a single-ink image is quantized with
+# PIL conversions alone, and only images none of them explains go through the generic ink search
+PNG_KNOWN_INKS = ("black", "green", "pink")
+PNG_KNOWN_INK_SLACK = 6  # largest per-channel difference (0-255) from an exact background / ink blend
 
-    # Extract the JSON string
-    strokes_str = llm_output[start_index:end_index + len(end_marker)].strip()#[:-1]
-    return strokes_str
+
+def _blend_fit(offsets, directions):
+    # best coverage of each ink for each pixel offset from the background, and the distance left unexplained
+    coverage = np.clip(offsets @ directions.T / np.maximum((directions ** 2).sum(axis=1), 1e-6), 0.0, 1.0)
+    residual = np.linalg.norm(offsets[:, None, :] - coverage[..., None] * directions[None], axis=2)
+    return coverage, residual
+
+
+def _line_art_coverage(rgb, background, max_inks):
+    """
+    Explain every pixel as the background blended with one ink color. Inks are picked among the most frequent
+    non-background colors, skipping those that are themselves a blend of the background and an earlier ink
+    (anti-aliased edges). Returns the inks, the per-pixel ink index and coverage in [0, 1], and the mean fit residual.
+    """
+    codes = rgb.reshape(-1, 3).astype(np.int32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.int32)
+    background_code = (background[0] << 16) | (background[1] << 8) | background[2]
+    foreground = np.flatnonzero(codes != background_code)
+    ink_index = np.zeros(len(codes), dtype=np.int64)
+    coverage = np.zeros(len(codes), dtype=np.float32)
+    if len(foreground) == 0:
+        return np.zeros((0, 3), dtype=np.float32), ink_index, coverage, 0.0
+
+    colors, counts = np.unique(codes[foreground], return_counts=True)
+    candidates = colors[np.argsort(-counts)[:PNG_INK_CANDIDATES]]
+    candidates = np.stack([(candidates >> 16) & 255, (candidates >> 8) & 255, candidates & 255], axis=1).astype(np.float32)
+    background = np.asarray(background, dtype=np.float32)
+    inks = candidates[:1]
+    for candidate in candidates[1:]:
+        if len(inks) == max_inks:
+            break
+        _, residual = _blend_fit((background - candidate)[None], background - inks)
+        if residual.min() > PNG_MAX_RESIDUAL:
+            inks = np.vstack([inks, candidate])
+
+    fg_coverage, fg_residual = _blend_fit(background - rgb.reshape(-1, 3)[foreground].astype(np.float32), background - inks)
+    best = fg_residual.argmin(axis=1)
+    rows = np.arange(len(foreground))
+    ink_index[foreground] = best
+    coverage[foreground] = fg_coverage[rows, best]
+    return inks, ink_index, coverage, float(fg_residual[rows, best].sum() / len(codes))
+
+
+def _ink_palette(inks, levels, background):
+    # index 0 is the background, then `levels` evenly spaced coverage steps per ink
+    background = np.asarray(background, dtype=np.float32)
+    palette = [background]
+    for ink in inks:
+        for step in range(1, levels + 1):
+            palette.append(background + (ink - background) * step / levels)
+    return np.clip(np.rint(np.asarray(palette)), 0, 255).astype(np.uint8)
+
+
+def _known_ink_coverage(rgb_image, ink, background):
+    """
+    Coverage ("L", 255 = full ink) of an RGB image drawn in the single ink `ink`, and the largest per-channel
+    difference between the image and background / ink blended by that coverage. Coverage is linear in the pixel
+    color, so it is one matrix conversion: 255 * coverage = 255 * (background - pixel) . direction / |direction|^2.
+    """
+    direction = np.asarray(background, dtype=np.float64) - ink
+    scale = 255.0 / (direction @ direction)
+    coverage = rgb_image.convert("L", matrix=tuple((-direction * scale).tolist()) + (float(np.dot(background, direction) * scale),))
+    blend = Image.composite(Image.new("RGB", rgb_image.size, tuple(ink.astype(int).tolist())), Image.new("RGB", rgb_image.size, tuple(background)), coverage)
+    return coverage, max(high for _, high in ImageChops.difference(blend, rgb_image).getextrema())
+
+
+def _quantize_known_ink(rgb_image, levels, background):
+    """
+    quantize_line_art for an image drawn in one of PNG_KNOWN_INKS, with PIL conversions only, or None if no known ink
+    explains every pixel. Inks are first checked on a 4x reduced copy: averaging blends of one ink gives blends of
+    that ink again, so a mismatch shows up there at a fraction of the cost.
+    """
+    preview = rgb_image.reduce(4)
+    for name in PNG_KNOWN_INKS:
+        ink = np.asarray(ImageColor.getrgb(name), dtype=np.float64)
+        if _known_ink_coverage(preview, ink, background)[1] > PNG_KNOWN_INK_SLACK:
+            continue
+        coverage, deviation = _known_ink_coverage(rgb_image, ink, background)
+        if deviation > PNG_KNOWN_INK_SLACK:
+            continue
+        quantized = coverage.point(np.rint(np.arange(256) * levels / 255).astype(np.int64).tolist())
+        quantized.putpalette(_ink_palette([ink], levels, background).ravel().tolist())  # turns the "L" image into "P"
+        return quantized
+    return None
+
+
+def quantize_line_art(image, encoding=PNG_ENCODING, palette_size=PNG_PALETTE_SIZE, max_inks=PNG_MAX_INKS, background=(255, 255, 255)):
+    """
+    Reduce a sketch (ink strokes on a plain background) to a small palette image.
+    Anti-aliased edge pixels are mapped by their coverage of the nearest ink rather than by raw color, so "palette"
+    keeps evenly spaced coverage levels per ink and "1bit" thresholds coverage at one half.
+    Images in one of PNG_KNOWN_INKS take a fast path (_quantize_known_ink); others have their inks searched for, and
+    images that are not line art (mean fit residual above PNG_MAX_RESIDUAL) fall back to an adaptive palette.
+    """
+    if encoding not in PNG_ENCODINGS:
+        raise ValueError(f"Unknown PNG encoding '{encoding}', expected one of {PNG_ENCODINGS}")
+    if encoding == "rgb":
+        return image
+    rgb_image = image.convert("RGB")
+    quantized = _quantize_known_ink(rgb_image, 1 if encoding == "1bit" else palette_size - 1, tuple(background))
+    if quantized is not None:
+        return quantized
+
+    rgb = np.asarray(rgb_image)
+    inks, ink_index, coverage, mean_residual = _line_art_coverage(rgb, tuple(background), max_inks)
+    if mean_residual > PNG_MAX_RESIDUAL:
+        return rgb_image.quantize(colors=256 if encoding == "palette" else 2)
+
+    # palette index 0 is the background, then `levels` coverage steps per ink ("1bit" is strictly 1-bit for a single ink)
+    levels = 1 if encoding == "1bit" else max((palette_size - 1) // max(len(inks), 1), 1)
+    steps = np.rint(coverage * levels).astype(np.int64)
+    indices = np.where(steps == 0, 0, 1 + ink_index * levels + steps - 1)
+    palette = _ink_palette(inks, levels, background)
+
+    quantized = Image.fromarray(indices.reshape(rgb.shape[:2]).astype(np.uint8), "P")
+    # a palette of 2 / 4 / 16 entries or fewer makes PIL write a 1 / 2 / 4-bit PNG
+    quantized.putpalette(palette.ravel().tolist())
+    return quantized
+
+
+def encode_png(image, encoding=PNG_ENCODING, compress_level=PNG_COMPRESS_LEVEL):
+    buffer = BytesIO()
+    quantize_line_art(image, encoding).save(buffer, format="PNG", compress_level=compress_level)
+    return buffer.getvalue()
+
+
+def save_png(image, path, encoding=PNG_ENCODING, compress_level=PNG_COMPRESS_LEVEL):
+    """Write a sketch PNG with the small-palette encoding (see quantize_line_art)."""
+    quantize_line_art(image, encoding).save(path, format="PNG", compress_level=compress_level)
+
+
+# =====================================
+# ===== Render cache ==================
+# =====================================
+RENDER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "render_cache")
+RENDER_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+RENDER_CACHE_DISK_BYTES = 512 * 1024 * 1024
+
+
+class RenderCache:
+    """
+    Rendered images (encoded bytes, e.g. PNG) keyed by a hash of (SVG, size, background, output format).
+    A memory tier sits in front of an optional on-disk tier; both are LRU and bounded by their total size in bytes.
+    Thread-safe, so one instance can serve all Flask request threads.
+    """
+    def __init__(self, cache_dir=None, max_memory_bytes=RENDER_CACHE_MEMORY_BYTES, max_disk_bytes=RENDER_CACHE_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()  # key -> bytes, least recently used first
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # key -> file size
+        self.disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # pick up what earlier processes left, oldest first
+            entries = [entry for entry in os.scandir(cache_dir) if entry.is_file() and entry.name.endswith(".bin")]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self.disk[entry.name[:-len(".bin")]] = entry.stat().st_size
+                self.disk_bytes += entry.stat().st_size
+
+    @staticmethod
+    def make_key(svg, size=None, background=None, fmt="png"):
+        svg_bytes = svg.encode("utf-8") if isinstance(svg, str) else svg
+        digest = hashlib.sha256(svg_bytes)
+        digest.update(f"|{size}|{background}|{fmt}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return data
+            if key in self.disk:
+                try:
+                    with open(self._disk_path(key), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    self.disk_bytes -= self.disk.pop(key)
+                else:
+                    self.disk.move_to_end(key)
+                    os.utime(self._disk_path(key))
+                    self.hits_disk += 1
+                    self._put_memory(key, data)
+                    return data
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        with self.lock:
+            self._put_memory(key, data)
+            if self.cache_dir is not None and key not in self.disk and len(data) <= self.max_disk_bytes:
+                # write-then-rename so a concurrent reader never sees a partial file
+                tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._disk_path(key))
+                self.disk[key] = len(data)
+                self.disk_bytes += len(data)
+                while self.disk_bytes > self.max_disk_bytes:
+                    old_key, old_size = self.disk.popitem(last=False)
+                    self.disk_bytes -= old_size
+                    try:
+                        os.remove(self._disk_path(old_key))
+                    except OSError:
+                        pass
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, old_data = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_data)
+
+    def get_or_render(self, svg, render_fn, size=None, background=None, fmt="png"):
+        """Return the cached bytes for this SVG, or call render_fn() (which must produce exactly that) and cache its result."""
+        key = self.make_key(svg, size, background, fmt)
+        data = self.get(key)
+        if data is None:
+            data = render_fn()
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+        }
+
+    def clear(self):
+        with self.lock:
+            if self.cache_dir is not None:
+                for key in self.disk:
+                    try:
+                        os.remove(self._disk_path(key))
+                    except OSError:
+                        pass
+            self.memory.clear()
+            self.disk.clear()
+            self.memory_bytes = self.disk_bytes = 0
+
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    """The process-wide RenderCache, backed by RENDER_CACHE_DIR."""
+    global _render_cache
+    with _render_cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache(cache_dir=RENDER_CACHE_DIR)
+        return _render_cache
+
+
+# =====================================
+# ===== Worker pool ===================
+# =====================================
+WORKER_POOL_KINDS = ("process", "thread", "inline")
+# defaults, overridable per deployment through the environment
+WORKER_POOL_KIND = os.environ.get("SKETCHAGENT_WORKER_POOL", "process")
+WORKER_POOL_WORKERS = int(os.environ.get("SKETCHAGENT_WORKERS", "0")) or None  # None: one per CPU
+WORKER_POOL_MAX_PENDING = int(os.environ.get("SKETCHAGENT_MAX_PENDING", "32"))
+# Fitting fewer strokes than this takes about as long as the round trip to a worker process, so it runs in the caller
+POOL_MIN_STROKES = int(os.environ.get("SKETCHAGENT_POOL_MIN_STROKES", "8"))
+
+
+def _run_inline(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+def _process_context():
+    """forkserver where available, else spawn: workers must not fork the threaded server with its held locks and client state."""
+    return multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+def fit_runner(pool, num_strokes):
+    """pool.run for fitting num_strokes strokes, or a plain call when the batch is too small to be worth handing off."""
+    return pool.run if pool is not None and num_strokes >= POOL_MIN_STROKES else _run_inline
+
+
+def _timed_call(fn, args, kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class WorkerPool:
+    """
+    Runs CPU-bound fitting / rendering tasks off the Flask request threads, so they neither hold the GIL of the server
+    process nor stall requests that are only waiting on the LLM.
+    kind is "process" (falls back to "thread" if processes are unavailable) or "inline" (run in the caller).
+    At most max_pending tasks are queued or running; further callers block until a slot frees up. A task keeps its slot
+    until it actually finishes, also when the caller stopped waiting for it after task_timeout.
+    Every task records its queue wait and run time under its function name (see stats()).
+    """
+    def __init__(self, kind=WORKER_POOL_KIND, max_workers=WORKER_POOL_WORKERS, max_pending=WORKER_POOL_MAX_PENDING, task_timeout=None):
+        if kind not in WORKER_POOL_KINDS:
+            raise ValueError(f"Unknown worker pool '{kind}', expected one of {WORKER_POOL_KINDS}")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.task_timeout = task_timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.timings = {}  # task name -> [count, total wait, total run, max run] in seconds
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None and self.kind == "process":
+                try:
+                    self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_process_context())
+                except (OSError, NotImplementedError, ImportError, ValueError) as e:
+                    print(f"Process pool unavailable ({e}), falling back to threads")
+                    self.kind = "thread"
+            if self.executor is None and self.kind == "thread":
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sketch-worker")
+            return self.executor
+
+    def _fall_back_to_threads(self, e):
+        with self.lock:
+            print(f"Process pool failed ({e}), falling back to threads")
+            self.executor = None
+            self.kind = "thread"
+
+    def _submit(self, fn, args, kwargs):
+        """Take a slot and submit the task; the slot is given back when the future completes, not when the caller returns."""
+        self.slots.acquire()
+        try:
+            future = self._get_executor().submit(_timed_call, fn, args, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in the pool and wait for its result. Exceptions raised by fn propagate."""
+        queued = time.perf_counter()
+        if self._get_executor() is None:
+            with self.slots:
+                result, run_time = _timed_call(fn, args, kwargs)
+        else:
+            try:
+                result, run_time = self._submit(fn, args, kwargs).result(self.task_timeout)
+            except BrokenProcessPool as e:
+                self._fall_back_to_threads(e)
+                result, run_time = self._submit(fn, args, kwargs).result(self.task_timeout)
+        self._record(getattr(fn, "__qualname__", repr(fn)), time.perf_counter() - queued - run_time, run_time)
+        return result
+
+    def _record(self, name, wait_time, run_time):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += wait_time
+            timing[2] += run_time
+            timing[3] = max(timing[3], run_time)
+
+    def stats(self):
+        with self.lock:
+            tasks = {name: {"count": count, "mean_wait_ms": 1000 * wait / count, "mean_run_ms": 1000 * run / count, "max_run_ms": 1000 * max_run}
+                     for name, (count, wait, run, max_run) in self.timings.items()}
+        return {"kind": self.kind, "max_workers": self.max_workers, "max_pending": self.max_pending, "tasks": tasks}
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def configure_worker_pool(kind=WORKER_POOL_KIND, max_workers=WORKER_POOL_WORKERS, max_pending=WORKER_POOL_MAX_PENDING, task_timeout=None):
+    """Replace the process-wide WorkerPool (call before serving requests)."""
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is not None:
+            _worker_pool.shutdown()
+        _worker_pool = WorkerPool(kind, max_workers, max_pending, task_timeout)
+        return _worker_pool
+
+
+def get_worker_pool():
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool()
+        return _worker_pool